@@ -0,0 +1,98 @@
+"""
+Memory used by parsed reddit listings: full child dicts against the slotted
+records built by reddit_adapter.parse_listing_child
+
+Run from the repository root with: python -m benchmarks.listing_memory
+"""
+
+import gc
+import json
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import reddit_adapter
+
+LISTINGS = 200
+POSTS_PER_LISTING = 100
+
+
+def fake_child(i: int) -> Dict[str, Any]:
+    # Roughly the shape and size of a real t3 child
+    data: Dict[str, Any] = {
+        "id": f"s{i:05x}",
+        "kind": "t3",
+        "title": f"Post number {i} with a reasonably long title to look real",
+        "selftext": "Some text " * 30,
+        "selftext_html": "&lt;div class=&quot;md&quot;&gt;Some text&lt;/div&gt;" * 10,
+        "subreddit": "python",
+        "subreddit_id": "t5_2qh0y",
+        "subreddit_name_prefixed": "r/python",
+        "permalink": f"/r/python/comments/s{i:05x}/post_number_{i}/",
+        "url": f"https://i.redd.it/{i:012x}.jpg",
+        "created_utc": 1642364229.0 + i,
+        "created": 1642364229.0 + i,
+        "score": i,
+        "ups": i,
+        "downs": 0,
+        "upvote_ratio": 0.97,
+        "num_comments": i // 3,
+        "over_18": False,
+        "author": "someone",
+        "author_fullname": "t2_abcdef",
+        "all_awardings": [{"id": "award", "name": "Silver", "coin_price": 100}] * 3,
+        "link_flair_richtext": [{"e": "text", "t": "Discussion"}],
+        "preview": {
+            "images": [
+                {
+                    "source": {
+                        "url": f"https://preview.redd.it/{i}.jpg",
+                        "width": 4000,
+                    },
+                    "resolutions": [
+                        {
+                            "url": f"https://preview.redd.it/{i}.jpg?width={w}",
+                            "width": w,
+                        }
+                        for w in (108, 216, 320, 640, 960, 1080)
+                    ],
+                    "variants": {},
+                    "id": f"preview{i}",
+                }
+            ],
+            "enabled": True,
+        },
+    }
+    for flag in range(60):
+        data[f"some_flag_{flag}"] = None if flag % 2 else False
+    return {"kind": "t3", "data": data}
+
+
+def measure(parse: Callable[[Dict[str, Any]], Any]) -> int:
+    raw = json.dumps(
+        {"data": {"children": [fake_child(i) for i in range(POSTS_PER_LISTING)]}}
+    )
+    gc.collect()
+    tracemalloc.start()
+    kept: List[Any] = []
+    for _ in range(LISTINGS):
+        children = json.loads(raw)["data"]["children"]
+        kept.append([parse(child) for child in children])
+        del children
+    gc.collect()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    posts = LISTINGS * POSTS_PER_LISTING
+    dict_size = measure(lambda child: child["data"])
+    record_size = measure(reddit_adapter.parse_listing_child)
+    print(f"{posts} posts in {LISTINGS} listings")
+    print(f"dicts:   {dict_size / 2**20:8.1f} MiB, {dict_size / posts:8.0f} B/post")
+    print(f"records: {record_size / 2**20:8.1f} MiB, {record_size / posts:8.0f} B/post")
+    print(f"records use {record_size / dict_size:.1%} of the dict memory")
+
+
+if __name__ == "__main__":
+    main()
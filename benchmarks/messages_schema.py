@@ -0,0 +1,107 @@
+"""
+File size and insert throughput of the messages table before and after
+subscriptions_manager.compact_messages_table: text post ids and subreddits
+with a rowid and a duplicate index, against integer ids, interned
+subreddits and WITHOUT ROWID
+
+Run from the repository root with: python -m benchmarks.messages_schema
+"""
+
+import os
+import random
+import tempfile
+import time
+from typing import List, Tuple
+
+import subscriptions_manager
+
+CHATS = 500
+SUBREDDITS = 300
+MESSAGES = 200_000
+# Rows per transaction, as flushed by subscriptions_manager.WRITE_BUFFER
+BATCH = 200
+
+LEGACY_INSERT = "INSERT INTO messages(chat_id, post_id, subreddit) VALUES (?,?,?)"
+
+
+def to_base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = ""
+    while number:
+        number, digit = divmod(number, 36)
+        text = digits[digit] + text
+    return text
+
+
+def fake_messages() -> List[Tuple[int, str, str]]:
+    rng = random.Random(0)
+    return [
+        (
+            rng.randrange(CHATS) * 1_000_003,
+            to_base36(rng.randrange(36**5, 36**7)),
+            f"r/subreddit_number_{rng.randrange(SUBREDDITS)}",
+        )
+        for _ in range(MESSAGES)
+    ]
+
+
+def open_database(path: str):
+    subscriptions_manager.close_connections()
+    subscriptions_manager.DB_PATH = path
+    return subscriptions_manager.get_connection()
+
+
+def insert(statements: List[Tuple[str, subscriptions_manager.Parameters]]) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(statements), BATCH):
+        subscriptions_manager.run_batch(statements[i : i + BATCH])
+    return MESSAGES / (time.perf_counter() - start)
+
+
+def file_size(path: str) -> int:
+    connection = subscriptions_manager.get_connection()
+    connection.execute("VACUUM")
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(path)
+
+
+def main():
+    messages = fake_messages()
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = os.path.join(directory, "legacy.db")
+        connection = open_database(legacy_path)
+        with connection:
+            subscriptions_manager.create_legacy_tables(connection)
+        legacy_rate = insert([(LEGACY_INSERT, message) for message in messages])
+        legacy_size = file_size(legacy_path)
+
+        start = time.perf_counter()
+        subscriptions_manager.create_tables()
+        migration_time = time.perf_counter() - start
+        migrated_size = file_size(legacy_path)
+
+        compact_path = os.path.join(directory, "compact.db")
+        open_database(compact_path)
+        subscriptions_manager.create_tables()
+        statements: List[Tuple[str, subscriptions_manager.Parameters]] = []
+        for chat_id, post_id, subreddit in messages:
+            statements.append((subscriptions_manager.INTERN_SUBREDDIT, (subreddit,)))
+            statements.append(
+                (
+                    subscriptions_manager.MARK_AS_SENT,
+                    (chat_id, subscriptions_manager.post_id_to_int(post_id), subreddit),
+                )
+            )
+        compact_rate = insert(statements)
+        subscriptions_manager.close_connections()
+
+    print(f"{MESSAGES} messages")
+    print(f"legacy:  {legacy_size / 2**20:6.1f} MiB, {legacy_rate:8.0f} inserts/s")
+    print(
+        f"compact: {migrated_size / 2**20:6.1f} MiB, {compact_rate:8.0f} inserts/s "
+        f"(migrated in {migration_time:.1f}s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Queries per second of a delivery-like workload (already_sent lookups and
+mark_as_sent inserts) with a new sqlite3 connection per statement, as
+subscriptions_manager used to do, against its pooled WAL connections
+
+Run from the repository root with: python -m benchmarks.sqlite_queries
+"""
+
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Any, Callable, List, Tuple
+
+import subscriptions_manager
+
+CHATS = 100
+QUERIES = 5000
+# Like a delivery: many already_sent checks for each post marked as sent
+SELECTS_PER_INSERT = 10
+
+
+def connect_per_query_select(path: str, query: str, parameters: Tuple[Any, ...]):
+    with sqlite3.connect(path) as connection:
+        return connection.execute(query, parameters).fetchall()
+
+
+def connect_per_query_sql(path: str, query: str, parameters: Tuple[Any, ...]):
+    with sqlite3.connect(path) as connection:
+        connection.execute(query, parameters)
+
+
+def run(
+    select: Callable[[str, Tuple[Any, ...]], List[Any]],
+    sql: Callable[[str, Tuple[Any, ...]], None],
+) -> float:
+    start = time.perf_counter()
+    for i in range(QUERIES):
+        chat_id = i % CHATS
+        if i % SELECTS_PER_INSERT:
+            select(
+                "SELECT * FROM messages WHERE chat_id=? AND post_id=?",
+                (chat_id, i),
+            )
+        else:
+            sql("INSERT INTO messages(chat_id, post_id) VALUES (?,?)", (chat_id, i))
+    return QUERIES / (time.perf_counter() - start)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        before_path = os.path.join(directory, "before.db")
+        subscriptions_manager.close_connections()
+        subscriptions_manager.DB_PATH = before_path
+        subscriptions_manager.create_tables()
+        subscriptions_manager.close_connections()
+        with sqlite3.connect(before_path) as connection:
+            connection.execute("PRAGMA journal_mode=DELETE")
+        before = run(
+            lambda q, p: connect_per_query_select(before_path, q, p),
+            lambda q, p: connect_per_query_sql(before_path, q, p),
+        )
+
+        subscriptions_manager.DB_PATH = os.path.join(directory, "after.db")
+        subscriptions_manager.create_tables()
+        after = run(subscriptions_manager.run_select, subscriptions_manager.run_sql)
+        subscriptions_manager.close_connections()
+
+    print(f"connection per query: {before:10.0f} queries/s")
+    print(f"pooled WAL:           {after:10.0f} queries/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ from aiogram.dispatcher.filters import Command
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types.message import Message
 
+import credentials
 import reddit_adapter
 import subscriptions_manager
 import telegram_adapter
@@ -77,10 +78,10 @@ def _normalize_sub(sub: str) -> str:
 async def add_subscription(chat_id: int, sub: str) -> bool:
     monthly_rank = 31
     sub = _normalize_sub(sub)
-    error = reddit_adapter.get_posts_error(sub, monthly_rank)
+    error = await reddit_adapter.get_posts_error(sub)
     if error:
         await send_message(chat_id, error)
-    if not subscriptions_manager.subscribe(chat_id, sub, monthly_rank):
+    if not await subscriptions_manager.subscribe(chat_id, sub, monthly_rank):
         await send_message(chat_id, f"You are already subscribed to {sub}")
         return False
     return True
@@ -94,10 +95,10 @@ async def add_subscriptions(chat_id: int, subs: List[str]):
         )
         return
     for sub in subs:
-        if subscriptions_manager.is_subscribed(chat_id, sub):
+        if await subscriptions_manager.is_subscribed(chat_id, sub):
             await send_message(chat_id, f"You are already subscribed to {sub}")
             return
-        err = reddit_adapter.get_posts_error(sub, 31)
+        err = await reddit_adapter.get_posts_error(sub)
         if err:
             await send_message(chat_id, err)
             return
@@ -106,8 +107,11 @@ async def add_subscriptions(chat_id: int, subs: List[str]):
         await add_subscription(chat_id, sub)
     await send_message(chat_id, f"You have subscribed to {', '.join(subs)}")
     await list_subscriptions(chat_id)
-    for sub in subs:
-        await workers.send_subscription_update(sub, chat_id, 31)
+    try:
+        for sub in subs:
+            await workers.send_subscription_update(sub, chat_id, 31)
+    except telegram_adapter.SendingPaused:
+        pass  # the scheduler sends them once the pause ends
 
 
 @dp.channel_post_handler(state=StateMachine.asked_add)
@@ -149,12 +153,12 @@ async def handle_add(message: types.Message):
 async def remove_subscriptions(chat_id: int, subs: List[str]):
     subs = [_normalize_sub(sub) for sub in subs]
     for sub in subs:
-        if not subscriptions_manager.is_subscribed(chat_id, sub):
+        if not await subscriptions_manager.is_subscribed(chat_id, sub):
             await send_message(chat_id, f"Error: not subscribed to {sub}")
             return
 
     for sub in subs:
-        subscriptions_manager.unsubscribe(chat_id, sub)
+        await subscriptions_manager.unsubscribe(chat_id, sub)
     await send_message(chat_id, f"You have unsubscribed from {', '.join(subs)}")
     await list_subscriptions(chat_id)
 
@@ -178,8 +182,8 @@ async def remove_reply_handler(message: types.Message, state):
     await state.finish()
 
 
-def sub_list_keyboard(chat_id: int, command: str):
-    subreddits = subscriptions_manager.user_subreddits(chat_id)
+async def sub_list_keyboard(chat_id: int, command: str):
+    subreddits = await subscriptions_manager.user_subreddits(chat_id)
     subreddits.sort(reverse=True)
     if not subreddits or len(subreddits) > 60:
         return types.ReplyKeyboardRemove()
@@ -215,7 +219,7 @@ async def handle_remove(message: types.Message):
     if len(text.split()) > 1:
         await remove_subscriptions(chat_id, text.split()[1:])
     else:
-        subreddits = subscriptions_manager.user_subreddits(chat_id)
+        subreddits = await subscriptions_manager.user_subreddits(chat_id)
         subreddits.sort()
         if not subreddits:
             await reply(
@@ -224,7 +228,7 @@ async def handle_remove(message: types.Message):
             )
         else:
             await StateMachine.asked_remove.set()
-            markup = sub_list_keyboard(chat_id, "remove")
+            markup = await sub_list_keyboard(chat_id, "remove")
             await reply(
                 message,
                 "Which subreddit would you like to unsubscribe from?",
@@ -247,13 +251,13 @@ async def change_threshold(
     chat_id: int, sub: str, factor: float, original_message: Message | None = None
 ):
     sub = _normalize_sub(sub)
-    if not subscriptions_manager.is_subscribed(chat_id, sub):
+    if not await subscriptions_manager.is_subscribed(chat_id, sub):
         await send_message(
             chat_id, f"You are not subscribed to {sub}, press /add to subscribe"
         )
         return
 
-    current_monthly = subscriptions_manager.get_per_month(chat_id, sub)
+    current_monthly = await subscriptions_manager.get_per_month(chat_id, sub)
     new_monthly = round(current_monthly * factor)
     if new_monthly == current_monthly and factor != 1:
         if factor > 1:
@@ -267,11 +271,11 @@ async def change_threshold(
     if new_monthly < 1:
         await send_message(chat_id=chat_id, text="Press /remove to unsubscribe")
         return
-    err = reddit_adapter.get_posts_error(sub, new_monthly)
+    err = await reddit_adapter.get_posts_error(sub)
     if err:
         await send_message(chat_id=chat_id, text=err)
         return
-    subscriptions_manager.update_per_month(chat_id, sub, new_monthly)
+    await subscriptions_manager.update_per_month(chat_id, sub, new_monthly)
     message_text = f"You will receive about {format_period(new_monthly)} " f"from {sub}"
     inline_keyboard = types.InlineKeyboardMarkup()
     inline_keyboard.row(
@@ -335,7 +339,7 @@ async def handle_change_threshold(message: types.Message, factor: float):
     if len(text.split()) > 1:
         await change_threshold(chat_id, text.split(None, 1)[1], factor=factor)
     else:
-        subreddits = subscriptions_manager.user_subreddits(chat_id)
+        subreddits = await subscriptions_manager.user_subreddits(chat_id)
         subreddits.sort()
         if not subreddits:
             await reply(
@@ -345,10 +349,10 @@ async def handle_change_threshold(message: types.Message, factor: float):
         else:
             if factor >= 1:
                 await StateMachine.asked_more.set()
-                markup = sub_list_keyboard(chat_id, "more")
+                markup = await sub_list_keyboard(chat_id, "more")
             else:
                 await StateMachine.asked_less.set()
-                markup = sub_list_keyboard(chat_id, "less")
+                markup = await sub_list_keyboard(chat_id, "less")
 
             question_template = "From which subreddit would you like to get {} updates?"
             question = question_template.format("more" if factor > 1 else "fewer")
@@ -385,14 +389,37 @@ async def handle_less(message: types.Message):
 @dp.message_handler(commands=["check"])
 async def handle_check(message: types.Message):
     chat_id: int = message["chat"]["id"]
-    subs = list(subscriptions_manager.user_subscriptions(chat_id))
-    for sub, per_month in subs:
-        await workers.send_subscription_update(sub, chat_id, per_month)
+    subs = list(await subscriptions_manager.user_subscriptions(chat_id))
+    try:
+        for sub, per_month in subs:
+            await workers.send_subscription_update(sub, chat_id, per_month)
+    except telegram_adapter.SendingPaused:
+        pass  # the scheduler sends them once the pause ends
     await send_message(chat_id, "checked")
 
 
+@dp.message_handler(commands=["stats"])
+async def handle_stats(message: types.Message):
+    chat_id: int = message["chat"]["id"]
+    if chat_id != credentials.ADMIN_ID:
+        return
+    cache_stats = reddit_adapter.LISTING_CACHE.stats()
+    budget = reddit_adapter.RATE_LIMITER.budget()
+    sent_cache_stats = subscriptions_manager.SENT_CACHE.stats()
+    await send_message(
+        chat_id,
+        f"Listing cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+        f"{cache_stats['size']} entries\n"
+        f"Reddit quota: {budget['remaining']} remaining, {budget['used']} used, "
+        f"resets in {budget['reset_in']:.0f}s, "
+        f"one request every {budget['interval']:.2f}s\n"
+        f"Sent posts cache: {sent_cache_stats['chats']} chats, "
+        f"{sent_cache_stats['bytes'] / 2**20:.1f} MiB",
+    )
+
+
 async def list_subscriptions(chat_id: int):
-    subscriptions = list(subscriptions_manager.user_subscriptions(chat_id))
+    subscriptions = list(await subscriptions_manager.user_subscriptions(chat_id))
     if subscriptions:
         for sub_list in chunks(subscriptions, 20):
             text_list = "\n\n".join(
@@ -402,7 +429,7 @@ async def list_subscriptions(chat_id: int):
                 )
                 for sub, per_month in sub_list
             )
-            markup = sub_list_keyboard(chat_id, "change_th")
+            markup = await sub_list_keyboard(chat_id, "change_th")
             await send_message(
                 chat_id,
                 f"You are currently subscribed to:\n\n{text_list}",
@@ -472,4 +499,6 @@ async def help_message(message: Message):
 
 if __name__ == "__main__":
     # TODO use async with job queue
-    executor.start_polling(dp, on_startup=workers.on_startup)
+    executor.start_polling(
+        dp, on_startup=workers.on_startup, on_shutdown=workers.on_shutdown
+    )
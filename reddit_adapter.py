@@ -1,15 +1,34 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import random
 import re
 import time
 import urllib.parse
+from collections import OrderedDict
 from datetime import datetime
-from functools import lru_cache
-from typing import Any, Dict, List, Literal, Optional, Set, TypedDict
+from typing import (
+    Any,
+    AsyncIterator,
+    Collection,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    TypeVar,
+    cast,
+)
 
 import httpx
 
+import subscriptions_manager
 from credentials import (
     REDDIT_CLIENT_ID,
     REDDIT_CLIENT_SECRET,
@@ -17,18 +36,85 @@ from credentials import (
     REDDIT_USERNAME,
 )
 
+USER_AGENT = "my-subreddits-bot-0.1"
+
+# One pooled client for every reddit call, so connections are kept alive
+CLIENT_SESSION = httpx.AsyncClient(
+    headers={"user-agent": USER_AGENT},
+    timeout=120,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+)
 
-@lru_cache(maxsize=2)
-def get_token(hour):
-    url = "https://www.reddit.com/api/v1/access_token"
-    data = {
-        "grant_type": "password",
-        "username": REDDIT_USERNAME,
-        "password": REDDIT_PASSWORD,
-    }
-    auth = (REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET)
-    response = httpx.post(url, data=data, auth=auth)
-    return response.json()["access_token"]
+
+class TokenManager:
+    """
+    Keeps a valid reddit OAuth token, refreshing it in the background before
+    it expires so that requests never wait for a refresh
+    """
+
+    def __init__(self, refresh_margin: float = 10 * 60):
+        # Refresh this many seconds before the token expires
+        self.refresh_margin = refresh_margin
+        self.token: Optional[str] = None
+        self.expires_at = 0.0
+        self._refresh_task: Optional[asyncio.Task[str]] = None
+
+    async def _fetch_token(self) -> str:
+        url = "https://www.reddit.com/api/v1/access_token"
+        data = {
+            "grant_type": "password",
+            "username": REDDIT_USERNAME,
+            "password": REDDIT_PASSWORD,
+        }
+        auth = (REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET)
+        response = await CLIENT_SESSION.post(url, data=data, auth=auth)
+        r_json = response.json()
+        self.token = r_json["access_token"]
+        self.expires_at = time.monotonic() + float(r_json.get("expires_in", 3600))
+        logging.info(f"Got a new reddit token, expires in {r_json.get('expires_in')}s")
+        return r_json["access_token"]
+
+    def refresh(self) -> asyncio.Task[str]:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch_token())
+            self._refresh_task.add_done_callback(_log_refresh_failure)
+        return self._refresh_task
+
+    async def get(self) -> str:
+        now = time.monotonic()
+        if self.token is None or now >= self.expires_at:
+            return await asyncio.shield(self.refresh())
+        if now >= self.expires_at - self.refresh_margin:
+            # The current token is still valid, use it while refreshing
+            self.refresh()
+        return self.token
+
+    async def invalidate(self, token: str) -> str:
+        """
+        Called when reddit rejects token, returns a fresh one
+        """
+        if self.token == token:
+            self.token = None
+        return await self.get()
+
+    async def keep_fresh(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                await asyncio.sleep(60)
+                continue
+            time_left = self.expires_at - self.refresh_margin - time.monotonic()
+            await asyncio.sleep(max(60, time_left))
+
+
+def _log_refresh_failure(task: asyncio.Task[str]):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"{task.exception()!r} while refreshing the reddit token")
+
+
+TOKEN_MANAGER = TokenManager()
 
 
 class Post(TypedDict):
@@ -86,6 +172,125 @@ class Comment(TypedDict):
     score: int
 
 
+class Record:
+    """
+    Slotted copy of the fields we use from a listing child, read like the
+    Post and Comment dicts it stands for: record["id"], record.get("preview")
+    """
+
+    __slots__: Tuple[str, ...] = ()
+
+    def __init__(self, data: Dict[str, Any]):
+        for field in self.__slots__:
+            setattr(self, field, data.get(field))
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __eq__(self, other: object) -> bool:
+        return type(self) is type(other) and all(
+            self[field] == other[field] for field in self.__slots__  # type: ignore
+        )
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{field}={self[field]!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class PostRecord(Record):
+    __slots__ = (
+        "kind",
+        "created_utc",
+        "id",
+        "num_comments",
+        "over_18",
+        "permalink",
+        "score",
+        "selftext",
+        "subreddit",
+        "title",
+        "url",
+        "is_gallery",
+        "media_metadata",
+        "gallery_data",
+        "preview",
+    )
+
+    def __init__(self, data: Dict[str, Any]):
+        super().__init__(data)
+        self.preview = _compact_preview(data.get("preview"))
+        self.media_metadata = _compact_media_metadata(data.get("media_metadata"))
+        self.gallery_data = _compact_gallery_data(data.get("gallery_data"))
+
+
+class CommentRecord(Record):
+    __slots__ = (
+        "kind",
+        "author",
+        "body",
+        "created_utc",
+        "id",
+        "link_title",
+        "link_url",
+        "num_comments",
+        "over_18",
+        "permalink",
+        "score",
+    )
+
+
+def _compact_preview(preview: Any) -> Optional[Dict[str, Any]]:
+    # Only the largest resolution of the first image is sent, see send_image
+    try:
+        url = preview["images"][0]["resolutions"][-1]["url"]
+    except (TypeError, LookupError):
+        return None
+    return {"images": [{"resolutions": [{"url": url}]}]}
+
+
+def _compact_media_metadata(
+    media_metadata: Any,
+) -> Optional[Dict[str, MediaMetadata]]:
+    # Keep what get_gallery_image_urls looks at: the full size image and
+    # the largest preview
+    if not isinstance(media_metadata, dict):
+        return None
+    compact: Dict[str, Any] = {}
+    for media_id, media_info in media_metadata.items():
+        info: Dict[str, Any] = {}
+        full_size = media_info.get("s")
+        if full_size:
+            info["s"] = {key: full_size.get(key) for key in ("x", "y", "u")}
+        previews = [p for p in media_info.get("p") or [] if p.get("u")]
+        if previews:
+            info["p"] = [{"u": previews[-1]["u"]}]
+        compact[media_id] = info
+    return compact
+
+
+def _compact_gallery_data(gallery_data: Any) -> Optional[GalleryData]:
+    if not isinstance(gallery_data, dict):
+        return None
+    items = gallery_data.get("items") or []
+    return {"items": [{"media_id": item["media_id"]} for item in items]}
+
+
+def parse_listing_child(child: Dict[str, Any]) -> Post | Comment:
+    child["data"]["kind"] = child["kind"]
+    if child["kind"] == "t3":
+        return cast(Post, PostRecord(child["data"]))
+    return cast(Comment, CommentRecord(child["data"]))
+
+
 def format_time_delta(delta_seconds: float) -> str:
     delta_seconds = int(delta_seconds)
     assert delta_seconds >= 0
@@ -125,12 +330,14 @@ def formatted_post(post: Post) -> str:
 
     time_ago = format_time_delta(datetime.now().timestamp() - post["created_utc"])
 
-    if len(post["selftext"]) > 2100:
-        post["selftext"] = post["selftext"][:2000] + "..."
+    # Posts can be cached and shared between chats, so don't modify them
+    selftext = post["selftext"]
+    if len(selftext) > 2100:
+        selftext = selftext[:2000] + "..."
 
-    post["selftext"] = markdown_to_html(post["selftext"])
-    if len(post["selftext"]) > 3100:
-        post["selftext"] = post["selftext"][:3000] + "..."
+    selftext = markdown_to_html(selftext)
+    if len(selftext) > 3100:
+        selftext = selftext[:3000] + "..."
 
     template = (
         '{}: <a href="{}">{}</a> - <a href="https://old.reddit.com{}">'
@@ -144,15 +351,16 @@ def formatted_post(post: Post) -> str:
         post["num_comments"],
         post["score"],
         time_ago,
-        post["selftext"],
+        selftext,
     )
 
 
 def formatted_comment(comment: Comment) -> str:
     time_ago = format_time_delta(datetime.now().timestamp() - comment["created_utc"])
 
-    if len(comment["body"]) > 2100:
-        comment["body"] = comment["body"][:2000] + "..."
+    body = comment["body"]
+    if len(body) > 2100:
+        body = body[:2000] + "..."
 
     template = (
         '{} on: <a href="{}">{}</a>'
@@ -164,13 +372,56 @@ def formatted_comment(comment: Comment) -> str:
         comment["author"],
         urllib.parse.quote(comment["link_url"], safe="/:?=&#"),
         comment["link_title"],
-        markdown_to_html(comment["body"]),
+        markdown_to_html(body),
         comment["permalink"],
         comment["score"],
         time_ago,
     )
 
 
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Least recently used cache whose entries expire after ttl seconds
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+
+    def get(self, key: K, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: K, value: V):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
 class SubredditBanned(Exception):
     pass
 
@@ -183,47 +434,223 @@ class InvalidAnswerFromEndpoint(Exception):
     pass
 
 
-last_get_time = 0
+class CircuitOpen(Exception):
+    pass
 
 
-def get_posts_from_endpoint(endpoint: str, retry: bool = True) -> List[Post | Comment]:
-    global last_get_time
-    bearer = get_token(hour=(time.time() // 7200))
-    headers = {
-        "user-agent": "my-subreddits-bot-0.1",
-        "Authorization": f"Bearer {bearer}",
-    }
-    r_json = None
-    response = None
-    if (time.time() - last_get_time) < 1:
-        # Max one request per second, or reddit gets mad
-        time.sleep(1 - (time.time() - last_get_time))
-    try:
-        last_get_time = time.time()
-        response = httpx.get(
-            endpoint, headers=headers, timeout=120, follow_redirects=True
-        )
-        r_json = response.json()
-        if not isinstance(r_json, dict):
-            raise InvalidAnswerFromEndpoint()
-    except Exception as e:
-        if retry:
-            logging.info(f"{e!r} sleeping 10 seconds before retrying contacting reddit")
-            time.sleep(10)
-            return get_posts_from_endpoint(endpoint, retry=False)
-        time.sleep(30)
-        raise InvalidAnswerFromEndpoint(f"{endpoint} returned invalid json {response}")
+class RateLimiter:
+    """
+    Spreads the requests left in reddit's quota (read from the X-Ratelimit-*
+    headers of every answer) evenly over the time left until the quota resets
+    """
+
+    def __init__(self, min_interval: float = 0.05, default_interval: float = 1):
+        # Never send requests closer than min_interval seconds
+        self.min_interval = min_interval
+        # Used until reddit tells us the actual quota
+        self.default_interval = default_interval
+        self.remaining: Optional[float] = None
+        self.used: Optional[float] = None
+        self.reset_at = 0.0
+        self._last_request = 0.0
+        self._lock = asyncio.Lock()
+
+    def interval(self) -> float:
+        now = time.monotonic()
+        if self.remaining is None or now >= self.reset_at:
+            return self.default_interval
+        if self.remaining < 1:
+            return self.reset_at - now
+        return max(self.min_interval, (self.reset_at - now) / self.remaining)
+
+    async def acquire(self):
+        async with self._lock:
+            time_to_wait = self._last_request + self.interval() - time.monotonic()
+            if time_to_wait > 0:
+                await asyncio.sleep(time_to_wait)
+            self._last_request = time.monotonic()
+            if self.remaining is not None:
+                self.remaining -= 1
+
+    def update(self, headers: httpx.Headers):
+        try:
+            remaining = float(headers["x-ratelimit-remaining"])
+            used = float(headers["x-ratelimit-used"])
+            reset = float(headers["x-ratelimit-reset"])
+        except (KeyError, ValueError):
+            return
+        self.remaining = remaining
+        self.used = used
+        self.reset_at = time.monotonic() + reset
+
+    def budget(self) -> Dict[str, float | None]:
+        return {
+            "remaining": self.remaining,
+            "used": self.used,
+            "reset_in": max(0.0, self.reset_at - time.monotonic()),
+            "interval": self.interval(),
+        }
+
+
+# Shared by every request to reddit
+RATE_LIMITER = RateLimiter()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, so that retries of requests that
+    failed together don't hit reddit together again
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 2, max_delay: float = 60):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    After failure_threshold consecutive failures for the same key, reject
+    requests for it during cooldown seconds, doubled every time it fails again
+    up to max_cooldown
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        cooldown: float = 5 * 60,
+        max_cooldown: float = 6 * 3600,
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+
+    def is_open(self, key: str) -> bool:
+        return self._open_until.get(key, 0) > time.time()
+
+    def retry_at(self, key: str) -> float:
+        return self._open_until.get(key, 0)
+
+    def record_success(self, key: str):
+        self._failures.pop(key, None)
+        self._open_until.pop(key, None)
+
+    def record_failure(self, key: str):
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        if failures >= self.failure_threshold:
+            doublings = failures - self.failure_threshold
+            cooldown = min(self.max_cooldown, self.cooldown * 2 ** min(doublings, 16))
+            self._open_until[key] = time.time() + cooldown
+            logging.warning(f"Not contacting reddit for {key} for {cooldown:.0f}s")
+
+
+# Keyed by subscription, so one failing subreddit doesn't stop the others
+CIRCUIT_BREAKER = CircuitBreaker()
+
+
+async def _authorized_get(endpoint: str, bearer: str) -> httpx.Response:
+    await RATE_LIMITER.acquire()
+    response = await CLIENT_SESSION.get(
+        endpoint, headers={"Authorization": f"Bearer {bearer}"}
+    )
+    RATE_LIMITER.update(response.headers)
+    return response
+
+
+class ListingPage(NamedTuple):
+    posts: List[Post | Comment]
+    # Cursor for the next page, None on the last one
+    after: Optional[str]
+
+
+_in_flight: Dict[str, asyncio.Task[ListingPage]] = {}
+
+
+async def get_page_from_endpoint(endpoint: str) -> ListingPage:
+    """
+    Concurrent calls for the same endpoint share a single request and result
+    """
+    task = _in_flight.get(endpoint)
+    if task is None:
+        task = asyncio.create_task(_get_page_from_endpoint(endpoint))
+        _in_flight[endpoint] = task
+
+        def forget(finished: asyncio.Task[ListingPage]):
+            if _in_flight.get(endpoint) is finished:
+                del _in_flight[endpoint]
+
+        task.add_done_callback(forget)
+    # Shielded so that a cancelled caller doesn't cancel the other waiters
+    return await asyncio.shield(task)
+
+
+async def get_posts_from_endpoint(endpoint: str) -> List[Post | Comment]:
+    return (await get_page_from_endpoint(endpoint)).posts
+
+
+async def _get_page_from_endpoint(endpoint: str) -> ListingPage:
+    r_json = await get_json(endpoint)
     if "data" in r_json:
         children: Any = r_json["data"]["children"]
-        for child in children:
-            child["data"]["kind"] = child["kind"]
-        return [c["data"] for c in children if c["kind"] in ("t1", "t3")]
+        posts = [
+            parse_listing_child(child)
+            for child in children
+            if child["kind"] in ("t1", "t3")
+        ]
+        return ListingPage(posts, r_json["data"].get("after"))
+    raise_for_reason(r_json)
+    raise Exception(f"{r_json} on {endpoint}")
+
+
+def raise_for_reason(r_json: Dict[str, Any]):
     if "error" in r_json and "reason" in r_json:
         if r_json["reason"] == "banned" or r_json["reason"] == "quarantined":
             raise SubredditBanned()
         if r_json["reason"] == "private":
             raise SubredditPrivate()
-    raise Exception(f"{r_json} on {endpoint}")
+
+
+async def get_json(endpoint: str) -> Dict[str, Any]:
+    """
+    Retries network errors and invalid answers according to RETRY_POLICY
+    """
+    for attempt in range(RETRY_POLICY.attempts):
+        try:
+            return await _get_json_once(endpoint)
+        except (httpx.HTTPError, InvalidAnswerFromEndpoint) as e:
+            if attempt + 1 >= RETRY_POLICY.attempts:
+                raise InvalidAnswerFromEndpoint(f"{endpoint} failed: {e!r}") from e
+            delay = RETRY_POLICY.delay(attempt)
+            logging.info(f"{e!r} retrying {endpoint} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    raise AssertionError("RETRY_POLICY.attempts must be at least 1")
+
+
+async def _get_json_once(endpoint: str) -> Dict[str, Any]:
+    bearer = await TOKEN_MANAGER.get()
+    response = await _authorized_get(endpoint, bearer)
+    if response.status_code == 401:
+        # The token expired early, retry once with a new one
+        bearer = await TOKEN_MANAGER.invalidate(bearer)
+        response = await _authorized_get(endpoint, bearer)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise InvalidAnswerFromEndpoint(f"{endpoint} returned {response}")
+    try:
+        r_json = response.json()
+    except ValueError:
+        r_json = None
+    if not isinstance(r_json, dict):
+        raise InvalidAnswerFromEndpoint(f"{endpoint} returned invalid json {response}")
+    return r_json
 
 
 BASE_URL = "https://oauth.reddit.com"
@@ -235,64 +662,391 @@ def is_subreddit(subscription: str) -> bool:
     return subscription.startswith("r/")
 
 
-def hot_posts(subscription: str, limit: int = 30) -> List[Post | Comment]:
+class ScoreThresholds:
+    """
+    Scores of each subreddit's top posts of the last 31 days, taken from the
+    month's top listing whenever it's fetched. threshold is the score a post
+    needs to rank among the per_month best, so candidates from a single hot
+    listing can be judged without fetching the top listings again
+    """
+
+    def __init__(self, max_age: float = 12 * 3600):
+        # Thresholds older than this are not used, forcing a top listing fetch
+        self.max_age = max_age
+        # subreddit -> (updated_at, [(created_utc, score)], listing_complete)
+        self._scores: Dict[str, Tuple[float, List[Tuple[int, int]], bool]] = {}
+
+    def update(self, subreddit: str, posts: List[Post | Comment], limit: int):
+        now = time.time()
+        scores = [(post["created_utc"], post["score"]) for post in posts]
+        # A listing shorter than asked holds every post of the month
+        complete = len(posts) < limit
+        current = self._scores.get(subreddit)
+        if (
+            current is None
+            or current[0] < now - self.max_age
+            or complete
+            or len(scores) >= len(current[1])
+        ):
+            self._scores[subreddit] = (now, scores, complete)
+
+    def threshold(self, subreddit: str, per_month: int) -> Optional[int]:
+        now = time.time()
+        entry = self._scores.get(subreddit)
+        if entry is None or entry[0] < now - self.max_age:
+            return None
+        _, created_scores, complete = entry
+        month_ago = now - 31 * 86400
+        scores = sorted(
+            (score for created, score in created_scores if created > month_ago),
+            reverse=True,
+        )
+        if per_month <= len(scores):
+            return scores[per_month - 1]
+        if complete:
+            # Fewer posts than per_month in the month, any post will do
+            return scores[-1] if scores else 0
+        return None
+
+
+SCORE_THRESHOLDS = ScoreThresholds()
+
+
+# (subscription, listing, time_period, limit, after)
+ListingKey = Tuple[str, str, Optional[str], int, Optional[str]]
+
+# Listings are shared by every chat following the same subscription
+LISTING_CACHE: TTLCache[ListingKey, ListingPage] = TTLCache(ttl=10 * 60, max_size=4096)
+
+
+async def get_listing_page(
+    subscription: str,
+    listing: str,
+    time_period: Optional[str],
+    limit: int,
+    after: Optional[str] = None,
+) -> ListingPage:
+    key = (subscription, listing, time_period, limit, after)
+    page = LISTING_CACHE.get(key)
+    if page is None:
+        if CIRCUIT_BREAKER.is_open(subscription):
+            retry_in = CIRCUIT_BREAKER.retry_at(subscription) - time.time()
+            raise CircuitOpen(f"{subscription} is failing, retry in {retry_in:.0f}s")
+        if not is_subreddit(subscription):
+            user = subscription.replace("u/", "user/")
+            endpoint = f"{BASE_URL}/{user}.json?sort={listing}&limit={limit}"
+        else:
+            endpoint = f"{BASE_URL}/{subscription}/{listing}.json?limit={limit}"
+        if time_period is not None:
+            endpoint += f"&t={time_period}"
+        if after is not None:
+            endpoint += f"&after={after}"
+        try:
+            page = await get_page_from_endpoint(endpoint)
+        except InvalidAnswerFromEndpoint:
+            CIRCUIT_BREAKER.record_failure(subscription)
+            raise
+        CIRCUIT_BREAKER.record_success(subscription)
+        LISTING_CACHE.put(key, page)
+        is_month_top = (listing, time_period, after) == ("top", "month", None)
+        if is_month_top and is_subreddit(subscription):
+            SCORE_THRESHOLDS.update(subscription, page.posts, limit)
+    return page
+
+
+async def get_listing(
+    subscription: str, listing: str, time_period: Optional[str], limit: int
+) -> List[Post | Comment]:
+    page = await get_listing_page(subscription, listing, time_period, limit)
+    return list(page.posts)
+
+
+async def iter_listing(
+    subscription: str, listing: str, time_period: Optional[str], limit: int
+) -> AsyncIterator[Post | Comment]:
+    """
+    Up to limit posts of a listing, fetched lazily in pages of at most 99 posts
+    by following reddit's after cursor: stop iterating to stop fetching.
+    The first page is the one hot_posts, new_posts and get_top_posts return
+    """
+    after = None
+    while limit > 0:
+        page = await get_listing_page(
+            subscription, listing, time_period, min(limit, 99), after
+        )
+        for post in page.posts[:limit]:
+            yield post
+        limit -= len(page.posts)
+        if page.after is None or not page.posts:
+            return
+        after = page.after
+
+
+async def hot_posts(subscription: str, limit: int = 30) -> List[Post | Comment]:
     if limit < 1:
         return []
     if limit > 99:
         limit = 99
-    endpoint = f"{BASE_URL}/{subscription}/hot.json?limit={limit}"
-    return get_posts_from_endpoint(endpoint)
+    return await get_listing(subscription, "hot", None, limit)
 
 
-def new_posts(subscription: str, limit: int = 30) -> List[Post | Comment]:
+async def new_posts(subscription: str, limit: int = 30) -> List[Post | Comment]:
     if limit < 1:
         return []
     if limit > 99:
         limit = 99
-    endpoint = f"{BASE_URL}/{subscription}/new.json?limit={limit}"
-    return get_posts_from_endpoint(endpoint)
+    return await get_listing(subscription, "new", None, limit)
 
 
-def get_top_posts(
+async def get_top_posts(
     subscription: str, time_period: str, limit: int
 ) -> List[Post | Comment]:
     if limit < 1:
         return []
     if limit > 99:
         limit = 99
-    if is_subreddit(subscription):
-        endpoint = f"{BASE_URL}/{subscription}/top.json?t={time_period}&limit={limit}"
-    else:
-        subscription = subscription.replace("u/", "user/")
-        endpoint = (
-            f"{BASE_URL}/{subscription}.json?sort=top&t={time_period}&limit={limit}"
-        )
-    return get_posts_from_endpoint(endpoint)
+    return await get_listing(subscription, "top", time_period, limit)
+
+
+# Subreddits combined in one r/a+b+c request, keeps the url short enough
+MULTIREDDIT_SIZE = 40
+
+
+async def new_posts_batch(
+    subscriptions: Collection[str], limit: int = 30
+) -> Dict[str, List[Post | Comment]]:
+    """
+    Newest posts of many subreddits, fetched MULTIREDDIT_SIZE subreddits at a
+    time from the combined r/a+b+c listing and split back by post subreddit.
+    A subscription is left out of the result (and should be fetched with
+    new_posts) if it's a user, if its batch failed, or if the combined listing
+    doesn't provably contain its newest limit posts
+    """
+    limit = min(max(limit, 1), 99)
+    subreddits = [sub for sub in subscriptions if is_subreddit(sub)]
+    results: Dict[str, List[Post | Comment]] = {}
+    for i in range(0, len(subreddits), MULTIREDDIT_SIZE):
+        batch = subreddits[i : i + MULTIREDDIT_SIZE]
+        names = "+".join(sub[2:] for sub in batch)
+        try:
+            posts = await get_posts_from_endpoint(
+                f"{BASE_URL}/r/{names}/new.json?limit=100"
+            )
+        except Exception as e:
+            logging.info(f"{e!r} getting r/{names}, they will be fetched one by one")
+            continue
+        # Subreddit names are case insensitive, subscriptions keep their case
+        by_subreddit: Dict[str, List[Post | Comment]] = {
+            sub.lower(): [] for sub in batch
+        }
+        for post in posts:
+            sub = f"r/{post['subreddit'].lower()}"  # type: ignore
+            if sub in by_subreddit:
+                by_subreddit[sub].append(post)
+        # Unless the listing was cut at 100 posts it has every recent post of
+        # every subreddit, otherwise only the newer ones
+        listing_complete = len(posts) < 100
+        for sub in batch:
+            sub_posts = by_subreddit[sub.lower()]
+            if listing_complete or len(sub_posts) >= limit:
+                results[sub] = sub_posts[:limit]
+                page = ListingPage(results[sub], None)
+                LISTING_CACHE.put((sub, "new", None, limit, None), page)
+    return results
+
+
+class SourceStats:
+    """
+    Tracks, per subscription, which of the listings merged by get_posts
+    supplied the delivered posts. The month's top posts are always fetched,
+    the other listings are skipped once they go patience fetches without
+    supplying a delivered post the month listing didn't have, except for an
+    occasional exploratory fetch to notice when they become useful again
+    """
 
+    def __init__(self, patience: int = 10, explore_probability: float = 0.1):
+        self.patience = patience
+        self.explore_probability = explore_probability
+        # subscription -> listing -> fetches since it last contributed
+        self._idle: Dict[str, Dict[str, int]] = {}
+        # subscription -> (listing -> post ids in order, fetch counted as idle)
+        # for the last fetch, which serves every chat delivered with it
+        self._candidates: TTLCache[str, Tuple[Dict[str, List[str]], List[bool]]] = (
+            TTLCache(ttl=3600, max_size=4096)
+        )
 
-def get_posts(subscription: str, per_month: int) -> List[Post | Comment]:
-    posts: List[Post | Comment] = []
-    posts.extend(get_top_posts(subscription, "month", per_month))
+    def should_fetch(self, subscription: str, source: str) -> bool:
+        if self._idle.get(subscription, {}).get(source, 0) < self.patience:
+            return True
+        return random.random() < self.explore_probability
+
+    def record_candidates(self, subscription: str, listings: Dict[str, List[str]]):
+        self._candidates.put(subscription, (listings, [False]))
+
+    def record_delivery(
+        self,
+        subscription: str,
+        post_id: str,
+        limits: Optional[Dict[str, int]] = None,
+    ):
+        """
+        limits are how many posts of each listing the chat looked at, all of
+        them by default
+        """
+        entry = self._candidates.get(subscription)
+        if entry is None:
+            return
+        listings, counted = entry
+        sources = {
+            source
+            for source, post_ids in listings.items()
+            if post_id in post_ids[: None if limits is None else limits.get(source, 0)]
+        }
+        if not sources:
+            return
+        idle = self._idle.setdefault(subscription, {})
+        if not counted[0]:
+            # Once per fetch, however many chats it served
+            counted[0] = True
+            for source in listings.keys() - {"month"}:
+                idle[source] = idle.get(source, 0) + 1
+        if "month" not in sources:
+            for source in sources:
+                idle[source] = 0
+
+
+SOURCE_STATS = SourceStats()
+
+
+def listing_limits(subscription: str, per_month: int) -> Dict[str, int]:
+    # How many posts of each listing get_posts looks at for per_month
+    limits = {"month": per_month}
     if 0 < per_month // 4 < 99:
-        posts.extend(get_top_posts(subscription, "week", limit=per_month // 2))
+        limits["week"] = per_month // 2
     if 0 < per_month // 31 < 99:
-        posts.extend(get_top_posts(subscription, "day", limit=per_month // 15))
+        limits["day"] = per_month // 15
     if is_subreddit(subscription):
-        posts.extend(hot_posts(subscription, per_month // 2))
+        limits["hot"] = per_month // 2
+    return {source: limit for source, limit in limits.items() if limit >= 1}
 
-    def get_score(post: Post | Comment):
-        return post["score"]
 
-    posts.sort(key=get_score, reverse=True)
+async def get_posts(
+    subscription: str, per_month: int, adaptive: bool = True
+) -> List[Post | Comment]:
+    """
+    Top posts from the month, week, day and hot listings, merged by score.
+    With adaptive, listings SOURCE_STATS deems useless are skipped
+    """
+    return await GroupListings(subscription, [per_month]).get_posts(
+        per_month, adaptive
+    )
 
-    seen_ids: Set[str] = set()
-    unique_posts: List[Post | Comment] = []
-    for post in posts:
-        if post["id"] in seen_ids:
-            continue
-        seen_ids.add(post["id"])
-        unique_posts.append(post)
-    return unique_posts
+
+class GroupListings:
+    """
+    get_posts, the hot listing and the month's top posts for subscriptions to
+    the same subscription with different per_month. Each listing is fetched
+    with the largest limit any of them needs, only once something asks for it,
+    and sliced for the others
+    """
+
+    def __init__(self, subscription: str, per_months: Collection[int]):
+        self.subscription = subscription
+        self._limits = {
+            per_month: listing_limits(subscription, per_month)
+            for per_month in per_months
+        }
+        self._max_limits: Dict[str, int] = {}
+        for limits in self._limits.values():
+            for source, limit in limits.items():
+                self._max_limits[source] = max(limit, self._max_limits.get(source, 0))
+        # adaptive -> listing -> posts
+        self._listings: Dict[bool, Dict[str, List[Post | Comment]]] = {}
+        self._lock = asyncio.Lock()
+
+    def _limit(self, per_month: int, source: str) -> int:
+        if per_month not in self._limits:
+            raise ValueError(f"{per_month=} is not one of the group's")
+        return self._limits[per_month].get(source, 0)
+
+    async def hot_posts(self, per_month: int) -> List[Post | Comment]:
+        limit = self._limit(per_month, "hot")
+        if limit < 1:
+            return []
+        return (await hot_posts(self.subscription, self._max_limits["hot"]))[:limit]
+
+    async def month_pages(self, per_month: int) -> AsyncIterator[List[Post | Comment]]:
+        """
+        The month's top per_month posts in pages of 99, fetched lazily. Pages
+        are requested like for the group's largest per_month, so every chat of
+        the group reads the same ones
+        """
+        limit = self._limit(per_month, "month")
+        page: List[Post | Comment] = []
+        async for post in iter_listing(
+            self.subscription, "top", "month", self._max_limits["month"]
+        ):
+            page.append(post)
+            limit -= 1
+            if len(page) == 99 or limit == 0:
+                yield page
+                page = []
+            if limit == 0:
+                return
+        if page:
+            yield page
+
+    async def _fetch(self, adaptive: bool) -> Dict[str, List[Post | Comment]]:
+        async with self._lock:
+            if adaptive in self._listings:
+                return self._listings[adaptive]
+            listings: Dict[str, List[Post | Comment]] = {}
+            for source, limit in self._max_limits.items():
+                if source == "month":
+                    listings[source] = await get_top_posts(
+                        self.subscription, "month", limit
+                    )
+                elif adaptive and not SOURCE_STATS.should_fetch(
+                    self.subscription, source
+                ):
+                    continue
+                elif source == "hot":
+                    listings[source] = await hot_posts(self.subscription, limit)
+                else:
+                    listings[source] = await get_top_posts(
+                        self.subscription, source, limit
+                    )
+            # Once for the whole group, whichever chat gets which post
+            SOURCE_STATS.record_candidates(
+                self.subscription,
+                {
+                    source: [post["id"] for post in listing]
+                    for source, listing in listings.items()
+                },
+            )
+            self._listings[adaptive] = listings
+            return listings
+
+    async def get_posts(
+        self, per_month: int, adaptive: bool = True
+    ) -> List[Post | Comment]:
+        posts: List[Post | Comment] = []
+        for source, listing in (await self._fetch(adaptive)).items():
+            posts.extend(listing[: self._limit(per_month, source)])
+
+        def get_score(post: Post | Comment):
+            return post["score"]
+
+        posts.sort(key=get_score, reverse=True)
+
+        seen_ids: Set[str] = set()
+        unique_posts: List[Post | Comment] = []
+        for post in posts:
+            if post["id"] in seen_ids:
+                continue
+            seen_ids.add(post["id"])
+            unique_posts.append(post)
+        return unique_posts
 
 
 # from https://github.com/reddit-archive/reddit/blob/753b17407e9a9dca09558526805922de24133d53/r2/r2/lib/validator/validator.py#L1570-L1571
@@ -309,20 +1063,105 @@ def valid_subscription(text: str) -> bool:
 allowed_subs = {"r/darkjokes", "r/modafinil"}
 
 
-def get_posts_error(sub: str, monthly_rank: int) -> Optional[str]:
+async def get_subreddit_about(subreddit: str) -> Optional[Dict[str, Any]]:
+    """
+    The about.json data of subreddit, None if it doesn't exist
+    """
+    r_json = await get_json(f"{BASE_URL}/{subreddit}/about.json")
+    if r_json.get("kind") == "t5":
+        return r_json["data"]
+    raise_for_reason(r_json)
+    return None
+
+
+# Subreddit metadata older than this is fetched again from reddit
+METADATA_MAX_AGE = 24 * 3600
+
+
+async def refresh_subreddit_metadata(
+    subreddit: str, with_activity: bool = True
+) -> subscriptions_manager.SubredditMetadata:
+    """
+    Fetch about.json (and, with_activity, the new listing to measure posts per
+    day) and store what was found in the subreddit_metadata table
+    """
+    about = over_18 = subscribers = posts_per_day = None
+    try:
+        about = await get_subreddit_about(subreddit)
+        status = "missing" if about is None else "available"
+    except SubredditBanned:
+        status = "banned"
+    except SubredditPrivate:
+        status = "private"
+    if about is not None:
+        over_18 = bool(about.get("over18"))
+        subscribers = about.get("subscribers")
+        if with_activity:
+            posts = await new_posts(subreddit, 99)
+            if posts:
+                oldest = min(post["created_utc"] for post in posts)
+                days = max(time.time() - oldest, 3600) / 86400
+                posts_per_day = len(posts) / days
+            else:
+                posts_per_day = 0
+    await subscriptions_manager.save_subreddit_metadata(
+        subreddit, status, over_18, subscribers, posts_per_day
+    )
+    metadata = await subscriptions_manager.get_subreddit_metadata(
+        subreddit, METADATA_MAX_AGE
+    )
+    assert metadata is not None
+    return metadata
+
+
+# sub -> error message or None, so a command checking a sub twice pays once
+VALIDATION_CACHE: TTLCache[str, Optional[str]] = TTLCache(ttl=10 * 60, max_size=1024)
+_MISSING = object()
+
+
+async def get_posts_error(sub: str) -> Optional[str]:
     if not valid_subscription(sub):
         return f"{sub} is not a valid subreddit or user name"
+    error = VALIDATION_CACHE.get(sub, _MISSING)
+    if error is _MISSING:
+        try:
+            error = await _subscription_error(sub)
+        except (CircuitOpen, InvalidAnswerFromEndpoint):
+            return f"Reddit is not answering about {sub}, try again later"
+        VALIDATION_CACHE.put(sub, error)
+    return error
+
+
+async def _subscription_error(sub: str) -> Optional[str]:
+    # A stored metadata lookup or about.json for subreddits, a listing for users
+    porn_error = (
+        f"{sub} seems to be a porn subreddit, if that's not the case contact @recursing"
+    )
     try:
-        posts = get_posts(sub, monthly_rank)
+        if is_subreddit(sub):
+            metadata = await subscriptions_manager.get_subreddit_metadata(
+                sub, METADATA_MAX_AGE
+            ) or await refresh_subreddit_metadata(sub, with_activity=False)
+            if metadata["status"] == "banned":
+                raise SubredditBanned()
+            if metadata["status"] == "private":
+                raise SubredditPrivate()
+            if metadata["status"] == "missing":
+                return f"{sub} does not exist or is empty or something"
+            if metadata["over_18"] and sub not in allowed_subs:
+                return porn_error
+            return None
+        posts = await get_top_posts(sub, "month", 31)
         if (
             posts
             and sum(post["over_18"] for post in posts) / len(posts) >= 0.8
             and (sub not in allowed_subs)
         ):
-            return f"{sub} seems to be a porn subreddit, if that's not the case contact @recursing"
+            return porn_error
         if not posts:
             return f"{sub} does not exist or is empty or something"
     except SubredditBanned:
         return f"{sub} has been banned"
     except SubredditPrivate:
         return f"{sub} is private"
+    return None
@@ -1,47 +1,284 @@
+import asyncio
+import hashlib
 import logging
+import math
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 logger = logging.getLogger(__name__)
 
+DB_PATH = "subscriptions.db"
 
-def exec_select(
-    query: str, parameters: Tuple[Union[str, int], ...] = ()
-) -> List[Tuple[Any, ...]]:
+Parameters = Tuple[Union[str, int, float, None], ...]
+
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    One long-lived connection per thread, so statements stay prepared in its
+    cache and the file isn't opened and parsed again for every query
+    """
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        connection = sqlite3.connect(
+            DB_PATH, cached_statements=256, check_same_thread=False
+        )
+        # WAL: readers don't block the writer, commits append to the log
+        # instead of syncing a rollback journal. With synchronous=NORMAL a
+        # power loss can lose the last commits but never corrupts the file
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA cache_size=-16000")  # 16MB
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA busy_timeout=5000")
+        _local.connection = connection
+        with _connections_lock:
+            _connections.append(connection)
+    return connection
+
+
+def close_connections():
+    global _local
+    with _connections_lock:
+        for connection in _connections:
+            connection.close()
+        _connections.clear()
+        _local = threading.local()
+
+
+# Reads run on a couple of threads, each with its own connection (WAL lets
+# them proceed while a write is in progress); all writes go through a single
+# thread, so they are serialized and never contend for the write lock
+_readers = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sqlite-reader")
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+
+def run_select(query: str, parameters: Parameters = ()) -> List[Tuple[Any, ...]]:
+    """
+    Blocking, runs on the calling thread
+    """
     assert query.startswith("SELECT")
     assert query.count("?") == len(parameters)
-    results = []
-    with sqlite3.connect("subscriptions.db") as connection:
-        cursor = connection.cursor()
-        cursor.execute(query, parameters)
-        results = cursor.fetchall()
-    return results
+    return get_connection().execute(query, parameters).fetchall()
 
 
-def exec_sql(query: str, parameters: Tuple[Union[str, int], ...] = ()) -> None:
+def run_sql(query: str, parameters: Parameters = ()) -> int:
+    """
+    Blocking, runs on the calling thread. Returns the number of changed rows
+    """
     assert query.count("?") == len(parameters)
-    # TODO proper mocking
-    # print(f"SQL: {query} {parameters}")
-    # return
-    with sqlite3.connect("subscriptions.db") as connection:
-        cursor = connection.cursor()
-        cursor.execute(query, parameters)
+    connection = get_connection()
+    with connection:
+        return connection.execute(query, parameters).rowcount
 
 
-def create_tables():
-    exec_sql(
+def run_sql_many(query: str, parameters: Iterable[Parameters]) -> None:
+    """
+    Blocking, runs on the calling thread, in a single transaction
+    """
+    connection = get_connection()
+    with connection:
+        connection.executemany(query, parameters)
+
+
+def run_batch(statements: List[Tuple[str, Parameters]]) -> None:
+    """
+    Blocking, runs on the calling thread, in a single transaction.
+    A statement breaking a constraint (like a duplicate message) is logged and
+    skipped, any other error rolls back the whole batch
+    """
+    connection = get_connection()
+    with connection:
+        for query, parameters in statements:
+            try:
+                connection.execute(query, parameters)
+            except sqlite3.IntegrityError as e:
+                logger.error(f"{e!r} running {query} {parameters}")
+
+
+class WriteBuffer:
+    """
+    Collects writes to commit them together in one transaction on the writer
+    thread, max_delay seconds after the first one or once there are max_rows.
+    Until then reads of the tables they touch flush them first
+    """
+
+    def __init__(self, max_delay: float = 0.25, max_rows: int = 200):
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        # (query, parameters, tables whose content the query changes)
+        self._rows: List[Tuple[str, Parameters, Tuple[str, ...]]] = []
+        self._in_flight: List[List[Tuple[str, Parameters, Tuple[str, ...]]]] = []
+        self._last_flush: Optional[asyncio.Future[None]] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task[None]] = None
+
+    async def write(self, query: str, parameters: Parameters, tables: Tuple[str, ...]):
+        assert query.count("?") == len(parameters)
+        self._rows.append((query, parameters, tables))
+        if len(self._rows) >= self.max_rows:
+            await self.flush()
+        else:
+            self._start_timer()
+
+    def _start_timer(self):
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        self._flush_task = asyncio.create_task(self.flush())
+        self._flush_task.add_done_callback(self._flushed_later)
+
+    def _flushed_later(self, task: "asyncio.Task[None]"):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{task.exception()!r} committing buffered writes, will retry")
+
+    def unflushed(self, query: str) -> List[Parameters]:
+        """
+        Parameters of the writes of query not committed yet
+        """
+        return [
+            parameters
+            for rows in (*self._in_flight, self._rows)
+            for row_query, parameters, _ in rows
+            if row_query == query
+        ]
+
+    def touches(self, query: str) -> bool:
+        return any(
+            table in query
+            for rows in (*self._in_flight, self._rows)
+            for _, _, tables in rows
+            for table in tables
+        )
+
+    async def flush(self):
+        """
+        Returns once every write made so far is committed
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows, self._rows = self._rows, []
+        if not rows:
+            # The writer runs batches in order, the last one finishes last
+            if self._last_flush is not None:
+                await asyncio.wait([self._last_flush])
+            return
+        self._in_flight.append(rows)
+        loop = asyncio.get_running_loop()
+        self._last_flush = loop.run_in_executor(
+            _writer, run_batch, [(query, parameters) for query, parameters, _ in rows]
+        )
+        try:
+            await self._last_flush
+        except sqlite3.Error:
+            # The transaction was rolled back: keep the rows for the next flush
+            self._rows[:0] = rows
+            self._start_timer()
+            raise
+        finally:
+            self._in_flight.remove(rows)
+
+
+WRITE_BUFFER = WriteBuffer()
+
+
+async def exec_select(
+    query: str, parameters: Parameters = (), flush: bool = True
+) -> List[Tuple[Any, ...]]:
+    """
+    flush=False skips committing buffered writes first: for callers that
+    account for WRITE_BUFFER.unflushed themselves
+    """
+    if flush and WRITE_BUFFER.touches(query):
+        await WRITE_BUFFER.flush()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, run_select, query, parameters)
+
+
+async def exec_sql(query: str, parameters: Parameters = ()) -> int:
+    await WRITE_BUFFER.flush()  # keep writes in order
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer, run_sql, query, parameters)
+
+
+async def exec_sql_many(query: str, parameters: Iterable[Parameters]) -> None:
+    await WRITE_BUFFER.flush()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_writer, run_sql_many, query, list(parameters))
+
+
+class ScheduleListener(Protocol):
+    """
+    Told about every change to when a subscription is due, so a scheduler
+    can keep its own copy instead of querying for the next subscription
+    """
+
+    def scheduled(
+        self,
+        chat_id: int,
+        subreddit: str,
+        per_month: int,
+        last_sent_at: Optional[float],
+        next_due_at: float,
+    ) -> None:
+        ...
+
+    def unscheduled(self, chat_id: int, subreddit: str) -> None:
+        ...
+
+    def sent(self, chat_id: int, subreddit: str, sent_at: float) -> None:
+        ...
+
+    def per_month_updated(self, chat_id: int, subreddit: str, per_month: int) -> None:
+        ...
+
+
+SCHEDULE_LISTENERS: List[ScheduleListener] = []
+
+
+def create_legacy_tables(connection: sqlite3.Connection):
+    """
+    The schema before it was versioned, created or completed in place
+    """
+    connection.execute(
         """
         CREATE TABLE IF NOT EXISTS subscriptions(
             chat_id INTEGER NOT NULL,
             subreddit TEXT NOT NULL CHECK(subreddit LIKE "r/%" OR subreddit LIKE "u/%"),
             per_month INTEGER NOT NULL,
             "timestamp" DATETIME,
+            last_sent_at REAL,
+            next_due_at REAL,
             PRIMARY KEY (chat_id, subreddit)
         );
         """
     )
-    exec_sql(
+    connection.execute(
         """
         CREATE TABLE IF NOT EXISTS exceptions (
             subreddit TEXT NOT NULL,
@@ -51,7 +288,7 @@ def create_tables():
         );
         """
     )
-    exec_sql(
+    connection.execute(
         """
         CREATE TABLE IF NOT EXISTS messages (
             chat_id INTEGER NOT NULL,
@@ -62,7 +299,19 @@ def create_tables():
         );
         """
     )
-    exec_sql(
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subreddit_metadata (
+            subreddit TEXT NOT NULL PRIMARY KEY,
+            status TEXT NOT NULL CHECK(status IN ('available', 'private', 'banned', 'missing')),
+            over_18 INTEGER,
+            subscribers INTEGER,
+            posts_per_day REAL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    connection.execute(
         """
         CREATE TRIGGER IF NOT EXISTS insert_Timestamp_Trigger
         AFTER INSERT ON subscriptions
@@ -72,149 +321,545 @@ def create_tables():
         END;
         """
     )
-    exec_sql(
+    add_due_columns(connection)
+    # Kept up to date by triggers, so picking the next subscription to update
+    # is a seek on subscriptions_next_due_at_idx instead of an aggregate over
+    # messages. Times are unix timestamps
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS subscription_due_insert_trigger
+        AFTER INSERT ON subscriptions
+        BEGIN
+            UPDATE subscriptions SET last_sent_at = (
+                SELECT CAST(strftime('%s', MAX(timestamp)) AS REAL) FROM messages
+                WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit
+            )
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+            UPDATE subscriptions
+            SET next_due_at = COALESCE(last_sent_at, 0) + 31 * 86400.0 / per_month
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+        END;
+        """
+    )
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS subscription_due_per_month_trigger
+        AFTER UPDATE OF per_month ON subscriptions
+        BEGIN
+            UPDATE subscriptions
+            SET next_due_at = COALESCE(last_sent_at, 0) + 31 * 86400.0 / NEW.per_month
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+        END;
+        """
+    )
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS subscription_due_message_trigger
+        AFTER INSERT ON messages
+        BEGIN
+            UPDATE subscriptions SET
+                last_sent_at = CAST(strftime('%s', 'now') AS REAL),
+                next_due_at = CAST(strftime('%s', 'now') AS REAL) + 31 * 86400.0 / per_month
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+        END;
+        """
+    )
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS subscriptions_next_due_at_idx ON subscriptions(next_due_at);
+        """
+    )
+    connection.execute(
         """
         CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages(timestamp);
         """
     )
-    exec_sql(
+    connection.execute(
         """
         CREATE INDEX IF NOT EXISTS messages_chat_id_post_id_idx ON messages(chat_id, post_id);
         """
     )
-    exec_sql(
+    connection.execute(
         """
         CREATE INDEX IF NOT EXISTS messages_chat_id_subreddit_timestamp_idx ON messages(chat_id, subreddit, timestamp);
         """
     )
 
 
-create_tables()
+def add_due_columns(connection: sqlite3.Connection):
+    """
+    Migration for databases created before subscriptions had
+    last_sent_at and next_due_at: add the columns and backfill them from messages
+    """
+    table_info = connection.execute("PRAGMA table_info(subscriptions)")
+    columns = [name for (_, name, *_) in table_info]
+    if "next_due_at" in columns:
+        return
+    logger.info("Adding last_sent_at and next_due_at to subscriptions")
+    connection.execute("ALTER TABLE subscriptions ADD COLUMN last_sent_at REAL")
+    connection.execute("ALTER TABLE subscriptions ADD COLUMN next_due_at REAL")
+    connection.execute(
+        """
+        UPDATE subscriptions SET last_sent_at = (
+            SELECT CAST(strftime('%s', MAX(timestamp)) AS REAL) FROM messages
+            WHERE messages.chat_id = subscriptions.chat_id
+            AND messages.subreddit = subscriptions.subreddit
+        )
+        """
+    )
+    connection.execute(
+        """
+        UPDATE subscriptions
+        SET next_due_at = COALESCE(last_sent_at, 0) + 31 * 86400.0 / per_month
+        """
+    )
+
+
+def compact_messages_table(connection: sqlite3.Connection):
+    """
+    messages stores post ids decoded from base 36 and subreddit ids from the
+    subreddits table instead of their text, and the unix time instead of a
+    datetime string. Being WITHOUT ROWID, the primary key is the table itself
+    instead of an index next to it, and the duplicate messages_chat_id_post_id_idx
+    goes with the old table. The no_message_found_at_ rows are dropped, they
+    only moved subscriptions.last_sent_at
+    """
+    connection.create_function(
+        "post_id_to_int", 1, post_id_to_int, deterministic=True
+    )
+    # Dropped with the old table, or referencing its columns
+    connection.execute("DROP TRIGGER IF EXISTS subscription_due_insert_trigger")
+    connection.execute(
+        """
+        CREATE TABLE subreddits (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        """
+    )
+    connection.execute(
+        """
+        INSERT INTO subreddits(name)
+        SELECT DISTINCT subreddit FROM messages WHERE subreddit IS NOT NULL
+        """
+    )
+    connection.execute(
+        """
+        CREATE TABLE compact_messages (
+            chat_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            sent_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            subreddit_id INTEGER,
+            PRIMARY KEY (chat_id, post_id)
+        ) WITHOUT ROWID;
+        """
+    )
+    connection.execute(
+        """
+        INSERT OR IGNORE INTO compact_messages
+        SELECT
+            chat_id,
+            post_id_to_int(post_id),
+            COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), 0),
+            subreddits.id
+        FROM messages LEFT JOIN subreddits ON subreddits.name = messages.subreddit
+        WHERE post_id != '' AND post_id NOT GLOB '*[^0-9a-z]*'
+        """
+    )
+    connection.execute("DROP TABLE messages")
+    connection.execute("ALTER TABLE compact_messages RENAME TO messages")
+    connection.execute(
+        """
+        CREATE INDEX messages_sent_at_idx ON messages(sent_at);
+        """
+    )
+    connection.execute(
+        """
+        CREATE INDEX messages_chat_id_subreddit_id_sent_at_idx ON messages(chat_id, subreddit_id, sent_at);
+        """
+    )
+    connection.execute(
+        """
+        CREATE TRIGGER subscription_due_insert_trigger
+        AFTER INSERT ON subscriptions
+        BEGIN
+            UPDATE subscriptions SET last_sent_at = (
+                SELECT MAX(sent_at) FROM messages
+                WHERE chat_id = NEW.chat_id
+                AND subreddit_id = (SELECT id FROM subreddits WHERE name = NEW.subreddit)
+            )
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+            UPDATE subscriptions
+            SET next_due_at = COALESCE(last_sent_at, 0) + 31 * 86400.0 / per_month
+            WHERE chat_id = NEW.chat_id AND subreddit = NEW.subreddit;
+        END;
+        """
+    )
+    connection.execute(
+        """
+        CREATE TRIGGER subscription_due_message_trigger
+        AFTER INSERT ON messages
+        BEGIN
+            UPDATE subscriptions SET
+                last_sent_at = NEW.sent_at,
+                next_due_at = NEW.sent_at + 31 * 86400.0 / per_month
+            WHERE chat_id = NEW.chat_id
+            AND subreddit = (SELECT name FROM subreddits WHERE id = NEW.subreddit_id);
+        END;
+        """
+    )
+
+
+# MIGRATIONS[i] brings the database from version i (PRAGMA user_version) to i+1
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    create_legacy_tables,
+    compact_messages_table,
+]
+
+
+def create_tables():
+    """
+    Runs the migrations DB_PATH is missing. Called on startup, not on import
+    """
+    connection = get_connection()
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    for new_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info(f"Migrating the database to version {new_version}")
+        connection.execute("BEGIN")
+        try:
+            migration(connection)
+            connection.execute(f"PRAGMA user_version = {new_version}")
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+
+def post_id_to_int(post_id: str) -> int:
+    """
+    Reddit ids are base 36 numbers
+    """
+    return int(post_id, 36)
 
 
 logger.info("Connected! (Hopefully)")
 
 
-def subscribe(chat_id: int, subreddit: str, monthly_rank: int) -> bool:
+async def subscribe(chat_id: int, subreddit: str, monthly_rank: int) -> bool:
     """
     returns False if the user is already subscribed
     """
-    if is_subscribed(chat_id, subreddit):
+    if await is_subscribed(chat_id, subreddit):
         return False
 
-    exec_sql(
+    await exec_sql(
         "INSERT INTO subscriptions (chat_id, subreddit, per_month) VALUES (?,?,?)",
         (chat_id, subreddit, monthly_rank),
     )
+    await notify_scheduled(chat_id, subreddit)
     return True
 
 
-def is_subscribed(chat_id: int, subreddit: str) -> bool:
-    results = exec_select(
+async def is_subscribed(chat_id: int, subreddit: str) -> bool:
+    results = await exec_select(
         "SELECT * FROM subscriptions WHERE chat_id=? AND subreddit=?",
         (chat_id, subreddit),
     )
     return bool(results)
 
 
-def unsubscribe(chat_id: int, subreddit: str) -> bool:
+async def unsubscribe(chat_id: int, subreddit: str) -> bool:
     """
     returns False if there is no matching subscription
     """
-    if not is_subscribed(chat_id, subreddit):
+    if not await is_subscribed(chat_id, subreddit):
         return False
-    exec_sql(
+    await exec_sql(
         "DELETE FROM subscriptions WHERE chat_id=? AND subreddit=?",
         (chat_id, subreddit),
     )
+    for listener in SCHEDULE_LISTENERS:
+        listener.unscheduled(chat_id, subreddit)
     return True
 
 
-def update_per_month(chat_id: int, subreddit: str, new_monthly_rank: int):
-    exec_sql(
+async def update_per_month(chat_id: int, subreddit: str, new_monthly_rank: int):
+    await WRITE_BUFFER.write(
         "UPDATE subscriptions SET per_month=? " " WHERE chat_id=? AND subreddit=?",
         (new_monthly_rank, chat_id, subreddit),
+        ("subscriptions",),
     )
+    # Not read back from the database, that would flush the write right away
+    for listener in SCHEDULE_LISTENERS:
+        listener.per_month_updated(chat_id, subreddit, new_monthly_rank)
 
 
-def get_subscriptions() -> List[Tuple[int, str, int]]:
-    return exec_select("SELECT chat_id, subreddit, per_month FROM subscriptions")  # type: ignore
+async def get_subscriptions() -> List[Tuple[int, str, int]]:
+    return await exec_select("SELECT chat_id, subreddit, per_month FROM subscriptions")  # type: ignore
 
 
-def get_per_month(chat_id: int, subreddit: str) -> int:
-    results = exec_select(
+async def get_per_month(chat_id: int, subreddit: str) -> int:
+    results = await exec_select(
         "SELECT per_month FROM subscriptions WHERE chat_id=? AND subreddit=?",
         (chat_id, subreddit),
     )
     return results[0][0]
 
 
-def all_subreddits() -> List[str]:
-    results = exec_select("SELECT DISTINCT subreddit FROM subscriptions")
+async def all_subreddits() -> List[str]:
+    results = await exec_select("SELECT DISTINCT subreddit FROM subscriptions")
     return [sub for (sub,) in results]
 
 
-def sub_followers(subreddit: str) -> List[Tuple[int, int]]:
-    return exec_select(  # type: ignore
+async def sub_followers(subreddit: str) -> List[Tuple[int, int]]:
+    return await exec_select(  # type: ignore
         "SELECT chat_id, per_month FROM subscriptions WHERE subreddit=?",
         (subreddit,),
     )
 
 
-def user_subreddits(chat_id: int) -> List[str]:
-    rows = exec_select(
+async def user_subreddits(chat_id: int) -> List[str]:
+    rows = await exec_select(
         "SELECT subreddit FROM subscriptions WHERE chat_id=?", (chat_id,)
     )
     return [sub for (sub,) in rows]
 
 
-def user_subscriptions(chat_id: int) -> List[Tuple[str, int]]:
-    return exec_select(  # type: ignore
+async def user_subscriptions(chat_id: int) -> List[Tuple[str, int]]:
+    return await exec_select(  # type: ignore
         "SELECT subreddit, per_month FROM subscriptions WHERE chat_id=?",
         (chat_id,),
     )
 
 
-def already_sent(chat_id: int, post_id: str) -> bool:
-    rows = exec_select(
-        "SELECT * FROM messages WHERE chat_id=? AND post_id=?", (chat_id, post_id)
+class BloomFilter:
+    """
+    Set membership in a fixed amount of memory: no false negatives, about
+    error_rate false positives while it holds at most capacity items
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.bits = bytearray(max(8, (num_bits + 7) // 8))
+        self.num_bits = len(self.bits) * 8
+        self.count = 0
+
+    def _positions(self, item: int) -> Iterable[int]:
+        digest = hashlib.blake2b(item.to_bytes(8, "little"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item: int):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: int) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def __len__(self) -> int:
+        """
+        Bytes used
+        """
+        return len(self.bits)
+
+
+class SentCache:
+    """
+    A BloomFilter of the (integer) post ids sent to each chat, loaded on first use and
+    kept up to date by mark_as_sent. A post not in the filter was definitely
+    not sent, only possible hits need a query. Least recently used chats are
+    dropped to stay within max_bytes, full filters are rebuilt larger
+    """
+
+    def __init__(self, max_bytes: int = 32 * 2**20, min_capacity: int = 1024):
+        self.max_bytes = max_bytes
+        self.min_capacity = min_capacity
+        self._filters: OrderedDict[int, BloomFilter] = OrderedDict()
+        self._bytes = 0
+        self._loads: Dict[int, asyncio.Task[BloomFilter]] = {}
+        # Sent while the chat's filter was loading, maybe after its query ran
+        self._sent_while_loading: Dict[int, List[int]] = {}
+
+    async def get(self, chat_id: int) -> BloomFilter:
+        bloom_filter = self._filters.get(chat_id)
+        if bloom_filter is not None:
+            self._filters.move_to_end(chat_id)
+            return bloom_filter
+        task = self._loads.get(chat_id)
+        if task is None:
+            self._sent_while_loading[chat_id] = []
+            task = asyncio.create_task(self._load(chat_id))
+            self._loads[chat_id] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, chat_id: int) -> BloomFilter:
+        try:
+            # Whether or not the query sees them
+            unflushed = unflushed_sent_ids(chat_id)
+            rows = await exec_select(
+                "SELECT post_id FROM messages WHERE chat_id=?", (chat_id,), flush=False
+            )
+            bloom_filter = BloomFilter(max(self.min_capacity, 2 * len(rows)))
+            for (post_id,) in rows:
+                bloom_filter.add(post_id)
+            for post_id in unflushed:
+                bloom_filter.add(post_id)
+            for post_id in self._sent_while_loading[chat_id]:
+                bloom_filter.add(post_id)
+            self._store(chat_id, bloom_filter)
+            return bloom_filter
+        finally:
+            del self._loads[chat_id]
+            del self._sent_while_loading[chat_id]
+
+    def _store(self, chat_id: int, bloom_filter: BloomFilter):
+        self.drop(chat_id)
+        self._filters[chat_id] = bloom_filter
+        self._bytes += len(bloom_filter)
+        while self._bytes > self.max_bytes and len(self._filters) > 1:
+            _, evicted = self._filters.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def drop(self, chat_id: int):
+        bloom_filter = self._filters.pop(chat_id, None)
+        if bloom_filter is not None:
+            self._bytes -= len(bloom_filter)
+
+    def sent(self, chat_id: int, post_id: int):
+        if chat_id in self._sent_while_loading:
+            self._sent_while_loading[chat_id].append(post_id)
+        bloom_filter = self._filters.get(chat_id)
+        if bloom_filter is None:
+            return
+        if bloom_filter.count >= bloom_filter.capacity:
+            self.drop(chat_id)  # reloaded with room to grow
+        else:
+            bloom_filter.add(post_id)
+
+    def clear(self):
+        self._filters.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._filters), "bytes": self._bytes}
+
+
+SENT_CACHE = SentCache()
+
+
+async def already_sent(chat_id: int, post_id: str) -> bool:
+    return bool(await already_sent_ids(chat_id, [post_id]))
+
+
+async def already_sent_ids(chat_id: int, post_ids: Collection[str]) -> Set[str]:
+    """
+    The subset of post_ids already sent to chat_id
+    """
+    bloom_filter = await SENT_CACHE.get(chat_id)
+    maybe_sent = {
+        post_id_to_int(post_id): post_id
+        for post_id in post_ids
+        if post_id_to_int(post_id) in bloom_filter
+    }
+    unflushed = unflushed_sent_ids(chat_id)
+    sent = {post_id for number, post_id in maybe_sent.items() if number in unflushed}
+    numbers = list(maybe_sent)
+    # Keep under SQLite's default limit of 999 parameters
+    for start in range(0, len(numbers), 500):
+        chunk = numbers[start : start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = await exec_select(
+            "SELECT post_id FROM messages "
+            f"WHERE chat_id=? AND post_id IN ({placeholders})",
+            (chat_id, *chunk),
+            flush=False,
+        )
+        sent.update(maybe_sent[number] for (number,) in rows)
+    return sent
+
+
+INTERN_SUBREDDIT = "INSERT OR IGNORE INTO subreddits(name) VALUES (?)"
+MARK_AS_SENT = """INSERT INTO messages(chat_id, post_id, subreddit_id)
+VALUES (?, ?, (SELECT id FROM subreddits WHERE name=?))"""
+
+
+def unflushed_sent_ids(chat_id: int) -> Set[int]:
+    return {
+        post_id  # type: ignore
+        for (sent_chat_id, post_id, _) in WRITE_BUFFER.unflushed(MARK_AS_SENT)
+        if sent_chat_id == chat_id
+    }
+
+
+async def mark_as_sent(chat_id: int, post_id: str, subreddit: str):
+    number = post_id_to_int(post_id)
+    await WRITE_BUFFER.write(INTERN_SUBREDDIT, (subreddit,), ("subreddits",))
+    # Triggers update subscriptions too
+    await WRITE_BUFFER.write(
+        MARK_AS_SENT, (chat_id, number, subreddit), ("messages", "subscriptions")
     )
-    return bool(rows)
+    SENT_CACHE.sent(chat_id, number)
+    sent_at = time.time()
+    for listener in SCHEDULE_LISTENERS:
+        listener.sent(chat_id, subreddit, sent_at)
 
 
-def mark_as_sent(chat_id: int, post_id: str, subreddit: str):
-    exec_sql(
-        "INSERT INTO messages(chat_id, post_id, subreddit) VALUES (?,?,?)",
-        (chat_id, post_id, subreddit),
+async def mark_as_checked(chat_id: int, subreddit: str):
+    """
+    Nothing was found to send: the subscription is due again as if something was
+    """
+    checked_at = time.time()
+    await WRITE_BUFFER.write(
+        "UPDATE subscriptions "
+        "SET last_sent_at=?, next_due_at=? + 31 * 86400.0 / per_month "
+        "WHERE chat_id=? AND subreddit=?",
+        (checked_at, checked_at, chat_id, subreddit),
+        ("subscriptions",),
     )
+    for listener in SCHEDULE_LISTENERS:
+        listener.sent(chat_id, subreddit, checked_at)
 
 
-def already_sent_exception(chat_id: int, subreddit: str, reason: str):
-    rows = exec_select(
+async def already_sent_exception(chat_id: int, subreddit: str, reason: str):
+    rows = await exec_select(
         "SELECT * FROM exceptions WHERE chat_id=? AND subreddit=? AND reason=?",
         (chat_id, subreddit, reason),
     )
     return bool(rows)
 
 
-def mark_exception_as_sent(chat_id: int, subreddit: str, reason: str):
-    exec_sql("INSERT INTO exceptions VALUES (?,?,?)", (subreddit, reason, chat_id))
+async def mark_exception_as_sent(chat_id: int, subreddit: str, reason: str):
+    await WRITE_BUFFER.write(
+        "INSERT INTO exceptions VALUES (?,?,?)",
+        (subreddit, reason, chat_id),
+        ("exceptions",),
+    )
 
 
-def delete_exception(subreddit: str):
-    exec_sql("DELETE FROM exceptions WHERE subreddit=?", (subreddit,))
+async def delete_exception(subreddit: str):
+    await exec_sql("DELETE FROM exceptions WHERE subreddit=?", (subreddit,))
 
 
-def get_old_subscribers(subreddit: str) -> List[int]:
-    rows = exec_select(
+async def get_old_subscribers(subreddit: str) -> List[int]:
+    rows = await exec_select(
         "SELECT DISTINCT chat_id FROM exceptions WHERE subreddit=?", (subreddit,)
     )
     return [chat_id for (chat_id,) in rows]
 
 
-def get_last_subscription_message(chat_id: int, subreddit: str) -> Optional[datetime]:
-    rows = exec_select(
-        "SELECT MAX(timestamp) from messages WHERE chat_id=? AND subreddit=?",
+async def get_last_subscription_message(
+    chat_id: int, subreddit: str
+) -> Optional[datetime]:
+    rows = await exec_select(
+        "SELECT datetime(MAX(sent_at), 'unixepoch') FROM messages "
+        "WHERE chat_id=? AND subreddit_id=(SELECT id FROM subreddits WHERE name=?)",
         (chat_id, subreddit),
     )
     for (timestamp,) in rows:
@@ -225,41 +870,162 @@ def get_last_subscription_message(chat_id: int, subreddit: str) -> Optional[date
     return None
 
 
-def unavailable_subreddits() -> List[str]:
-    rows = exec_select("SELECT DISTINCT subreddit FROM exceptions")
+async def unavailable_subreddits() -> List[str]:
+    rows = await exec_select("SELECT DISTINCT subreddit FROM exceptions")
+    return [sub for (sub,) in rows]
+
+
+async def delete_user(chat_id: int):
+    for sub in await user_subreddits(chat_id):
+        await unsubscribe(chat_id, sub)
+
+
+class SubredditMetadata(TypedDict):
+    subreddit: str
+    status: str
+    over_18: Optional[bool]
+    subscribers: Optional[int]
+    posts_per_day: Optional[float]
+    updated_at: datetime
+
+
+async def get_subreddit_metadata(
+    subreddit: str, max_age: float
+) -> Optional[SubredditMetadata]:
+    """
+    returns None if there is no metadata updated in the last max_age seconds
+    """
+    rows = await exec_select(
+        "SELECT subreddit, status, over_18, subscribers, posts_per_day, updated_at "
+        "FROM subreddit_metadata WHERE subreddit=? AND updated_at > datetime('now', ?)",
+        (subreddit, f"-{int(max_age)} seconds"),
+    )
+    for subreddit, status, over_18, subscribers, posts_per_day, updated_at in rows:
+        return {
+            "subreddit": subreddit,
+            "status": status,
+            "over_18": None if over_18 is None else bool(over_18),
+            "subscribers": subscribers,
+            "posts_per_day": posts_per_day,
+            "updated_at": datetime.fromisoformat(updated_at),
+        }
+    return None
+
+
+async def save_subreddit_metadata(
+    subreddit: str,
+    status: str,
+    over_18: Optional[bool] = None,
+    subscribers: Optional[int] = None,
+    posts_per_day: Optional[float] = None,
+):
+    """
+    Values left to None keep what was known before
+    """
+    await exec_sql(
+        """
+        INSERT INTO subreddit_metadata
+            (subreddit, status, over_18, subscribers, posts_per_day)
+        VALUES (?,?,?,?,?)
+        ON CONFLICT(subreddit) DO UPDATE SET
+            status=excluded.status,
+            over_18=COALESCE(excluded.over_18, over_18),
+            subscribers=COALESCE(excluded.subscribers, subscribers),
+            posts_per_day=COALESCE(excluded.posts_per_day, posts_per_day),
+            updated_at=CURRENT_TIMESTAMP
+        """,
+        (
+            subreddit,
+            status,
+            None if over_18 is None else int(over_18),
+            subscribers,
+            posts_per_day,
+        ),
+    )
+
+
+async def subreddits_with_stale_metadata(max_age: float, limit: int) -> List[str]:
+    """
+    Subscribed or unavailable subreddits without metadata updated in the last
+    max_age seconds, least recently updated first
+    """
+    rows = await exec_select(
+        """SELECT subs.subreddit FROM (
+    SELECT subreddit FROM subscriptions WHERE subreddit LIKE 'r/%'
+    UNION SELECT subreddit FROM exceptions WHERE subreddit LIKE 'r/%'
+) subs LEFT JOIN subreddit_metadata m ON m.subreddit = subs.subreddit
+WHERE m.updated_at IS NULL OR m.updated_at <= datetime('now', ?)
+ORDER BY m.updated_at ASC
+LIMIT ?
+""",
+        (f"-{int(max_age)} seconds", limit),
+    )
     return [sub for (sub,) in rows]
 
 
-def delete_user(chat_id: int):
-    for sub in user_subreddits(chat_id):
-        unsubscribe(chat_id, sub)
-
-
-def get_next_subscription_to_update() -> Tuple[str, int, int, float]:
-    subreddit, chat_id, per_month, time_left = exec_select(
-        """SELECT
-  subscriptions.subreddit, subscriptions.chat_id, subscriptions.per_month,
-  (
-    (31.0 * 24.0 * 3600.0 / per_month) -
-    (
-        CAST(strftime('%s', CURRENT_TIMESTAMP) as integer) -
-        COALESCE(
-            CAST(strftime('%s', t.last_message_timestamp) as integer),
-            0.0)
-    )
-  ) as priority
-FROM subscriptions LEFT JOIN (
-   SELECT chat_id, subreddit,
-      COALESCE(max(timestamp), 0) as last_message_timestamp
-    FROM messages
-    GROUP BY chat_id, subreddit
-    ORDER BY last_message_timestamp ASC
-  ) t ON (
-    t.chat_id = subscriptions.chat_id
-    AND t.subreddit = subscriptions.subreddit
-  )
-ORDER BY priority ASC
-LIMIT 1;
-"""
-    )[0]
-    return subreddit, chat_id, per_month, time_left
+async def notify_scheduled(chat_id: int, subreddit: str):
+    rows = await exec_select(
+        "SELECT per_month, last_sent_at, next_due_at FROM subscriptions "
+        "WHERE chat_id=? AND subreddit=?",
+        (chat_id, subreddit),
+    )
+    for per_month, last_sent_at, next_due_at in rows:
+        for listener in SCHEDULE_LISTENERS:
+            listener.scheduled(chat_id, subreddit, per_month, last_sent_at, next_due_at)
+
+
+async def get_schedule() -> List[Tuple[int, str, int, Optional[float], float]]:
+    """
+    (chat_id, subreddit, per_month, last_sent_at, next_due_at) of every subscription
+    """
+    return await exec_select(  # type: ignore
+        "SELECT chat_id, subreddit, per_month, last_sent_at, next_due_at "
+        "FROM subscriptions"
+    )
+
+
+async def save_next_due_times(due_times: Iterable[Tuple[float, int, str]]):
+    """
+    Takes (next_due_at, chat_id, subreddit) tuples
+    """
+    await exec_sql_many(
+        "UPDATE subscriptions SET next_due_at=? WHERE chat_id=? AND subreddit=?",
+        due_times,
+    )
+
+
+async def free_bytes() -> int:
+    """
+    Size of the pages in the database file that hold no data
+    """
+    rows = await exec_select(
+        "SELECT freelist_count * page_size FROM pragma_freelist_count, pragma_page_size"
+    )
+    return rows[0][0]
+
+
+async def delete_old_messages(
+    max_age_days: int = 90, batch_size: int = 500, pause: float = 0.1
+) -> Tuple[int, int]:
+    """
+    Deletes messages older than max_age_days, batch_size rows per transaction
+    so other writes can go in between. Posts that old are never sent again
+    and subscriptions.last_sent_at keeps when each subscription was last sent.
+    Returns the rows deleted and the bytes freed for reuse
+    """
+    free_before = await free_bytes()
+    deleted = 0
+    while True:
+        batch_deleted = await exec_sql(
+            """DELETE FROM messages WHERE (chat_id, post_id) IN (
+    SELECT chat_id, post_id FROM messages
+    WHERE sent_at < CAST(strftime('%s', 'now') AS INTEGER) - ?
+    LIMIT ?
+)""",
+            (max_age_days * 24 * 3600, batch_size),
+        )
+        deleted += batch_deleted
+        if batch_deleted < batch_size:
+            break
+        await asyncio.sleep(pause)
+    return deleted, await free_bytes() - free_before
@@ -5,7 +5,7 @@ import logging
 import time
 import traceback
 from functools import wraps
-from typing import Any, Awaitable, Callable
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 from aiogram import Bot, Dispatcher, exceptions
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
@@ -44,11 +44,61 @@ async def send_exception(e: Exception, message: str):
     await send_to_admin(message)
 
 
+class Backoff:
+    """
+    Pauses sending, to one chat after it hit flood control or to all of them
+    while telegram is unreachable. Senders wait without blocking the loop
+    """
+
+    def __init__(self):
+        self._until = 0.0
+        self._chat_until: Dict[int, float] = {}
+
+    def pause(self, seconds: float, chat_id: Optional[int] = None):
+        until = time.time() + seconds
+        if chat_id is None:
+            self._until = max(self._until, until)
+        else:
+            self._chat_until[chat_id] = max(self._chat_until.get(chat_id, 0), until)
+
+    def remaining(self, chat_id: Optional[int] = None) -> float:
+        now = time.time()
+        until = self._until
+        if chat_id is not None:
+            chat_until = self._chat_until.get(chat_id, 0)
+            if chat_until <= now:
+                self._chat_until.pop(chat_id, None)
+            until = max(until, chat_until)
+        return max(0.0, until - now)
+
+    async def wait(self, chat_id: Optional[int] = None):
+        # Pauses can be extended while waiting
+        while (delay := self.remaining(chat_id)) > 0:
+            await asyncio.sleep(delay)
+
+
+BACKOFF = Backoff()
+
+
+class SendingPaused(Exception):
+    """
+    The message was not sent because BACKOFF pauses its chat: the caller
+    retries it in delay seconds
+    """
+
+    def __init__(self, chat_id: Optional[int], delay: float):
+        super().__init__(f"Sending to {chat_id} paused for {delay:.0f}s")
+        self.delay = delay
+
+
 def catch_telegram_exceptions(
     func: Callable[..., Awaitable[bool]]
 ) -> Callable[..., Awaitable[bool]]:
     @wraps(func)
     async def wrap(*args, **kwargs) -> bool:
+        chat_id: Optional[int] = kwargs.get("chat_id") or (args[0] if args else None)
+        if (paused := BACKOFF.remaining(chat_id)) > 0:
+            raise SendingPaused(chat_id, paused)
         try:
             return await func(*args, **kwargs)
         except exceptions.InlineKeyboardExpected as e:
@@ -62,7 +112,6 @@ def catch_telegram_exceptions(
             exceptions.ChatNotFound,
             exceptions.BadRequest,
         ) as e:
-            chat_id = kwargs.get("chat_id") or args[0]
             unsub_reasons = [
                 "chat not found",
                 "bot was blocked by the user",
@@ -74,43 +123,61 @@ def catch_telegram_exceptions(
                 "bot is not a member",
                 "need administrator rights",
             ]
-            if any(reason in str(e).lower() for reason in unsub_reasons):
+            if chat_id is not None and any(
+                reason in str(e).lower() for reason in unsub_reasons
+            ):
                 logging.warning(f"Unsubscribing user {chat_id} for {e!r}")
-                subscriptions_manager.delete_user(chat_id)
+                await subscriptions_manager.delete_user(chat_id)
             else:
                 await send_exception(e, f"Failed to send {args} {kwargs}")
         except exceptions.MigrateToChat as e:
+            if chat_id is None:
+                await send_exception(e, f"Failed to send {args} {kwargs}")
+                return False
             new_chat_id = e.migrate_to_chat_id
-            old_chat_id = kwargs.get("chat_id") or args[0]
-            for sub, pm in subscriptions_manager.user_subscriptions(old_chat_id):
-                subscriptions_manager.subscribe(new_chat_id, sub, pm)
-                subscriptions_manager.unsubscribe(old_chat_id, sub)
+            for sub, pm in await subscriptions_manager.user_subscriptions(chat_id):
+                await subscriptions_manager.subscribe(new_chat_id, sub, pm)
+                await subscriptions_manager.unsubscribe(chat_id, sub)
         except exceptions.RetryAfter as e:
-            time_to_sleep = e.timeout + 1
-            logging.error(f"{e!r} RetryAfter error, sleeping {time_to_sleep=}")
-            time.sleep(time_to_sleep)
+            # Flood control is per chat, unless there's no chat to blame
+            logging.error(f"{e!r} RetryAfter error, pausing {chat_id=}")
+            BACKOFF.pause(e.timeout + 1, chat_id)
+            raise SendingPaused(chat_id, e.timeout + 1) from e
         except exceptions.NetworkError as e:
-            logging.error(f"{e!r} network error, sleeping")
-            time.sleep(60)
+            logging.error(f"{e!r} network error, pausing")
+            BACKOFF.pause(60)
+            raise SendingPaused(chat_id, 60) from e
         except (
             exceptions.NotFound,
             exceptions.RestartingTelegram,
             exceptions.TelegramAPIError,
         ) as e:
             await send_exception(e, f"TelegramApiError {args} {kwargs}")
-            logging.error(f"{e!r} Telegram error, sleeping")
-            time.sleep(60)  # Telegram maybe down, sleep a while
+            logging.error(f"{e!r} Telegram error, pausing")
+            BACKOFF.pause(60)  # Telegram maybe down, pause a while
         return False
 
     return wrap
 
 
 @catch_telegram_exceptions
-async def send_message(*args, **kwargs) -> bool:
+async def try_send_message(*args, **kwargs) -> bool:
     await bot.send_message(*args, **kwargs)
     return True
 
 
+async def send_message(*args, **kwargs) -> bool:
+    """
+    try_send_message, waiting out pauses. For messages nothing else would
+    send again, like command replies
+    """
+    while True:
+        try:
+            return await try_send_message(*args, **kwargs)
+        except SendingPaused as e:
+            await asyncio.sleep(e.delay)
+
+
 @catch_telegram_exceptions
 async def send_media(chat_id: int, post: reddit_adapter.Post, caption: str) -> bool:
     # parse_mode is always HTML
@@ -149,8 +216,6 @@ async def reply(message: Message, *args: Any, **kwargs: Any):
 async def send_post(
     chat_id: int, content: reddit_adapter.Post | reddit_adapter.Comment, subreddit: str
 ):
-    if subscriptions_manager.already_sent(chat_id, content["id"]):
-        return
     # TODO: handle images and gifs
     try:
         sent = False
@@ -163,9 +228,11 @@ async def send_post(
         else:  # comment
             formatted_post = reddit_adapter.formatted_comment(content)
         if not sent:
-            sent = await send_message(chat_id, formatted_post, parse_mode="HTML")
+            sent = await try_send_message(chat_id, formatted_post, parse_mode="HTML")
         if sent:
-            subscriptions_manager.mark_as_sent(chat_id, content["id"], subreddit)
+            await subscriptions_manager.mark_as_sent(chat_id, content["id"], subreddit)
+    except SendingPaused:
+        raise  # the delivery is retried once the pause ends
     except Exception as e:
         logging.error(f"{e!r} while sending content, sleeping")
         await send_exception(e, f"Uncaught sending {str(content)} to {chat_id}")
@@ -1,8 +1,10 @@
-from typing import Any
+import asyncio
+from typing import Any, List
 
+import httpx
 import pytest
 
-from .. import reddit_adapter
+from .. import media_handler, reddit_adapter
 
 
 def test_format_time_delta():
@@ -134,3 +136,399 @@ def test_formatted_comment(patch_datetime_now: Any):
 async def test_get_user_posts():
     # Just check this doesn't raise an exception
     await reddit_adapter.get_posts("u/thisisbillgates", 10)
+
+
+def test_ttl_cache(monkeypatch: pytest.MonkeyPatch):
+    now = 1000.0
+    monkeypatch.setattr(reddit_adapter.time, "monotonic", lambda: now)
+    cache: reddit_adapter.TTLCache[str, int] = reddit_adapter.TTLCache(
+        ttl=60, max_size=2
+    )
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    now += 61
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 2, "misses": 3, "size": 1}
+
+
+def test_rate_limiter_spreads_quota(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(reddit_adapter.time, "monotonic", lambda: 1000.0)
+    limiter = reddit_adapter.RateLimiter(min_interval=0.05, default_interval=1)
+    assert limiter.interval() == 1
+    limiter.update(
+        httpx.Headers(
+            {
+                "x-ratelimit-remaining": "300",
+                "x-ratelimit-used": "300",
+                "x-ratelimit-reset": "150",
+            }
+        )
+    )
+    assert limiter.interval() == 0.5
+    limiter.remaining = 0
+    assert limiter.interval() == 150
+    assert limiter.budget()["used"] == 300
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_call(monkeypatch: pytest.MonkeyPatch):
+    calls = []
+
+    async def fake_get_page_from_endpoint(endpoint: str):
+        calls.append(endpoint)
+        await asyncio.sleep(0.01)
+        return reddit_adapter.ListingPage([{"id": endpoint}], None)  # type: ignore
+
+    monkeypatch.setattr(
+        reddit_adapter, "_get_page_from_endpoint", fake_get_page_from_endpoint
+    )
+    results = await asyncio.gather(
+        reddit_adapter.get_posts_from_endpoint("a"),
+        reddit_adapter.get_posts_from_endpoint("a"),
+        reddit_adapter.get_posts_from_endpoint("b"),
+    )
+    assert calls == ["a", "b"]
+    assert results == [[{"id": "a"}], [{"id": "a"}], [{"id": "b"}]]
+    await reddit_adapter.get_posts_from_endpoint("a")
+    assert calls == ["a", "b", "a"]
+
+
+@pytest.mark.asyncio
+async def test_token_refreshed_in_background(monkeypatch: pytest.MonkeyPatch):
+    manager = reddit_adapter.TokenManager(refresh_margin=600)
+    fetched = asyncio.Event()
+
+    async def fake_fetch_token():
+        manager.token = "new"
+        manager.expires_at = reddit_adapter.time.monotonic() + 3600
+        fetched.set()
+        return "new"
+
+    monkeypatch.setattr(manager, "_fetch_token", fake_fetch_token)
+    assert await manager.get() == "new"
+
+    manager.token = "old"
+    manager.expires_at = reddit_adapter.time.monotonic() + 60
+    fetched.clear()
+    assert await manager.get() == "old"
+    await asyncio.wait_for(fetched.wait(), 1)
+    assert await manager.get() == "new"
+    assert await manager.invalidate("new") == "new"
+
+
+@pytest.mark.asyncio
+async def test_new_posts_batch_splits_multireddit(monkeypatch: pytest.MonkeyPatch):
+    endpoints = []
+
+    async def fake_get_posts_from_endpoint(endpoint: str):
+        endpoints.append(endpoint)
+        return [
+            {"id": "1", "subreddit": "Python"},
+            {"id": "2", "subreddit": "rust"},
+            {"id": "3", "subreddit": "Python"},
+            {"id": "4", "subreddit": "AskReddit"},
+        ]
+
+    monkeypatch.setattr(
+        reddit_adapter, "get_posts_from_endpoint", fake_get_posts_from_endpoint
+    )
+    monkeypatch.setattr(
+        reddit_adapter, "LISTING_CACHE", reddit_adapter.TTLCache(60, 10)
+    )
+    posts = await reddit_adapter.new_posts_batch(
+        ["r/python", "r/rust", "r/golang", "r/AskReddit", "u/someone"], limit=5
+    )
+    assert endpoints == [
+        "https://oauth.reddit.com/r/python+rust+golang+AskReddit/new.json?limit=100"
+    ]
+    assert posts == {
+        "r/python": [
+            {"id": "1", "subreddit": "Python"},
+            {"id": "3", "subreddit": "Python"},
+        ],
+        "r/rust": [{"id": "2", "subreddit": "rust"}],
+        "r/golang": [],
+        "r/AskReddit": [{"id": "4", "subreddit": "AskReddit"}],
+    }
+    cached = reddit_adapter.LISTING_CACHE.get(("r/AskReddit", "new", None, 5, None))
+    assert cached is not None and cached.posts == posts["r/AskReddit"]
+
+
+def test_post_record_keeps_only_used_fields():
+    child = {
+        "kind": "t3",
+        "data": {
+            "id": "s287ia",
+            "title": "Finally got this Kawai GL30!!",
+            "url": "https://i.redd.it/6780jwapt9b81.jpg",
+            "all_awardings": [],
+            "preview": {
+                "images": [
+                    {
+                        "source": {"url": "https://preview.redd.it/source.jpg"},
+                        "resolutions": [
+                            {"url": "https://preview.redd.it/small.jpg", "width": 108},
+                            {"url": "https://preview.redd.it/large.jpg", "width": 1080},
+                        ],
+                    }
+                ],
+            },
+            "is_gallery": True,
+            "media_metadata": {
+                "abc": {
+                    "status": "valid",
+                    "p": [{"x": 108, "y": 108, "u": "https://preview.redd.it/p.jpg"}],
+                    "s": {"x": 3000, "y": 3000, "u": "https://preview.redd.it/s.jpg"},
+                },
+                "def": {"status": "failed"},
+            },
+            "gallery_data": {
+                "items": [{"media_id": "def", "id": 1}, {"media_id": "abc", "id": 2}]
+            },
+        },
+    }
+    post = reddit_adapter.parse_listing_child(child)
+    assert isinstance(post, reddit_adapter.PostRecord)
+    assert post["kind"] == "t3"
+    assert post["title"] == "Finally got this Kawai GL30!!"
+    assert post.get("selftext", "") == ""
+    with pytest.raises(KeyError):
+        post["all_awardings"]  # type: ignore
+    assert post.get("preview", {})["images"][0]["resolutions"][-1]["url"] == (
+        "https://preview.redd.it/large.jpg"
+    )
+    assert media_handler.get_gallery_image_urls(post) == [  # type: ignore
+        "https://preview.redd.it/p.jpg"
+    ]
+
+
+def test_circuit_breaker(monkeypatch: pytest.MonkeyPatch):
+    now = 1000.0
+    monkeypatch.setattr(reddit_adapter.time, "time", lambda: now)
+    breaker = reddit_adapter.CircuitBreaker(failure_threshold=2, cooldown=60)
+    breaker.record_failure("r/a")
+    assert not breaker.is_open("r/a")
+    breaker.record_failure("r/a")
+    assert breaker.is_open("r/a")
+    now += 61
+    assert not breaker.is_open("r/a")
+    breaker.record_failure("r/a")  # fails again, twice the cooldown
+    assert breaker.retry_at("r/a") == now + 120
+    breaker.record_success("r/a")
+    assert not breaker.is_open("r/a")
+
+
+@pytest.mark.asyncio
+async def test_get_json_retries(monkeypatch: pytest.MonkeyPatch):
+    answers: List[Any] = [httpx.ConnectError("down"), {"data": {}}]
+
+    async def fake_get_json_once(endpoint: str):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    async def no_sleep(_delay: float):
+        pass
+
+    monkeypatch.setattr(reddit_adapter, "_get_json_once", fake_get_json_once)
+    monkeypatch.setattr(reddit_adapter.asyncio, "sleep", no_sleep)
+    assert await reddit_adapter.get_json("endpoint") == {"data": {}}
+
+    answers[:] = [reddit_adapter.InvalidAnswerFromEndpoint()] * 3
+    with pytest.raises(reddit_adapter.InvalidAnswerFromEndpoint):
+        await reddit_adapter.get_json("endpoint")
+
+
+@pytest.mark.asyncio
+async def test_iter_listing_follows_cursor(monkeypatch: pytest.MonkeyPatch):
+    endpoints = []
+
+    async def fake_get_page_from_endpoint(endpoint: str):
+        endpoints.append(endpoint)
+        page = len(endpoints)
+        posts = [
+            {"id": f"{page}_{i}", "score": 100 - i, "created_utc": 0} for i in range(99)
+        ]
+        return reddit_adapter.ListingPage(posts, f"t3_{page}_98")  # type: ignore
+
+    monkeypatch.setattr(
+        reddit_adapter, "LISTING_CACHE", reddit_adapter.TTLCache(60, 10)
+    )
+    monkeypatch.setattr(
+        reddit_adapter, "get_page_from_endpoint", fake_get_page_from_endpoint
+    )
+    listing = reddit_adapter.iter_listing("r/python", "top", "month", 250)
+    first = []
+    async for post in listing:
+        first.append(post)
+        if len(first) == 100:
+            break
+    assert len(endpoints) == 2
+    rest = [post async for post in listing]
+    assert len(first) + len(rest) == 250
+    assert endpoints == [
+        "https://oauth.reddit.com/r/python/top.json?limit=99&t=month",
+        "https://oauth.reddit.com/r/python/top.json?limit=99&t=month&after=t3_1_98",
+        "https://oauth.reddit.com/r/python/top.json?limit=52&t=month&after=t3_2_98",
+    ]
+
+
+def test_source_stats_skips_listings_that_dont_contribute():
+    stats = reddit_adapter.SourceStats(patience=2, explore_probability=0)
+    for _ in range(2):
+        assert stats.should_fetch("r/a", "week")
+        stats.record_candidates("r/a", {"month": ["1"], "week": ["1"], "hot": ["2"]})
+        # A fetch serving many chats counts once
+        for _ in range(5):
+            stats.record_delivery("r/a", "1")
+    assert not stats.should_fetch("r/a", "week")
+    assert not stats.should_fetch("r/a", "hot")
+    assert stats.should_fetch("r/b", "week")
+
+    stats.record_candidates("r/a", {"month": ["1"], "hot": ["4", "3"], "week": ["3"]})
+    # Beyond what this chat looked at in hot
+    stats.record_delivery("r/a", "3", {"month": 1, "hot": 1, "week": 1})
+    assert stats.should_fetch("r/a", "week")
+    assert not stats.should_fetch("r/a", "hot")
+
+
+def test_score_thresholds(monkeypatch: pytest.MonkeyPatch):
+    now = 1642364229.0
+    monkeypatch.setattr(reddit_adapter.time, "time", lambda: now)
+    thresholds = reddit_adapter.ScoreThresholds(max_age=3600)
+    posts: List[Any] = [
+        {"score": score, "created_utc": now - 86400} for score in (50, 40, 30)
+    ]
+    posts.append({"score": 1000, "created_utc": now - 40 * 86400})
+    thresholds.update("r/a", posts, limit=4)
+    assert thresholds.threshold("r/a", 1) == 50
+    assert thresholds.threshold("r/a", 3) == 30
+    assert thresholds.threshold("r/a", 5) is None  # listing was cut at 4 posts
+    assert thresholds.threshold("r/b", 1) is None
+
+    thresholds.update("r/a", posts[:3], limit=10)
+    assert thresholds.threshold("r/a", 5) == 30
+    now += 3601
+    assert thresholds.threshold("r/a", 1) is None
+
+
+@pytest.mark.asyncio
+async def test_subscription_validation_is_cached(monkeypatch: pytest.MonkeyPatch):
+    endpoints = []
+
+    async def fake_get_json(endpoint: str):
+        endpoints.append(endpoint)
+        if "banned" in endpoint:
+            return {"reason": "banned", "message": "Not Found", "error": 404}
+        if "missing" in endpoint:
+            return {"message": "Not Found", "error": 404}
+        return {"kind": "t5", "data": {"over18": "nsfw" in endpoint}}
+
+    stored_metadata = {}
+
+    async def fake_get_subreddit_metadata(subreddit: str, _max_age):
+        return stored_metadata.get(subreddit)
+
+    async def fake_save_subreddit_metadata(subreddit: str, status: str, over_18, *_):
+        stored_metadata[subreddit] = {"status": status, "over_18": over_18}
+
+    monkeypatch.setattr(reddit_adapter, "get_json", fake_get_json)
+    monkeypatch.setattr(
+        reddit_adapter, "VALIDATION_CACHE", reddit_adapter.TTLCache(60, 10)
+    )
+    monkeypatch.setattr(
+        reddit_adapter.subscriptions_manager,
+        "get_subreddit_metadata",
+        fake_get_subreddit_metadata,
+    )
+    monkeypatch.setattr(
+        reddit_adapter.subscriptions_manager,
+        "save_subreddit_metadata",
+        fake_save_subreddit_metadata,
+    )
+    assert await reddit_adapter.get_posts_error("r/python") is None
+    assert await reddit_adapter.get_posts_error("r/python") is None
+    assert endpoints == ["https://oauth.reddit.com/r/python/about.json"]
+    assert (
+        await reddit_adapter.get_posts_error("r/banned") == "r/banned has been banned"
+    )
+    assert "does not exist" in await reddit_adapter.get_posts_error("r/missing")
+    assert "porn" in await reddit_adapter.get_posts_error("r/nsfwsub")
+    assert "not a valid" in await reddit_adapter.get_posts_error("r/a")
+
+    reddit_adapter.VALIDATION_CACHE.clear()
+    endpoints.clear()
+    assert (
+        await reddit_adapter.get_posts_error("r/banned") == "r/banned has been banned"
+    )
+    assert endpoints == []  # answered from the stored metadata
+
+
+@pytest.mark.asyncio
+async def test_group_listings_fetch_each_listing_once(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    calls = []
+
+    def listing(source: str, limit: int):
+        return [
+            {"id": f"{source}{i}", "score": 1000 - i * 10 - len(source)}
+            for i in range(limit)
+        ]
+
+    async def fake_get_top_posts(_subscription, time_period: str, limit: int):
+        calls.append((time_period, limit))
+        return listing(time_period, limit)
+
+    async def fake_hot_posts(_subscription, limit: int):
+        calls.append(("hot", limit))
+        return listing("hot", limit)
+
+    candidates = []
+    stats = reddit_adapter.SourceStats()
+    monkeypatch.setattr(
+        stats, "record_candidates", lambda *args: candidates.append(args)
+    )
+    monkeypatch.setattr(reddit_adapter, "get_top_posts", fake_get_top_posts)
+    monkeypatch.setattr(reddit_adapter, "hot_posts", fake_hot_posts)
+    monkeypatch.setattr(reddit_adapter, "SOURCE_STATS", stats)
+
+    listings = reddit_adapter.GroupListings("r/python", [8, 62])
+    # Nothing is fetched until asked for, hot with the group's largest limit
+    assert [post["id"] for post in await listings.hot_posts(8)] == [
+        f"hot{i}" for i in range(4)
+    ]
+    assert calls == [("hot", 31)]
+
+    posts = await listings.get_posts(8, adaptive=False)
+    assert {post["id"] for post in posts} == {
+        *(f"month{i}" for i in range(8)),
+        *(f"week{i}" for i in range(4)),
+        *(f"hot{i}" for i in range(4)),
+    }
+    await listings.get_posts(62, adaptive=False)
+    assert sorted(calls) == [
+        ("day", 4),
+        ("hot", 31),
+        ("hot", 31),
+        ("month", 62),
+        ("week", 31),
+    ]
+    # Once, from everything fetched
+    assert len(candidates) == 1
+    assert {source: len(ids) for source, ids in candidates[0][1].items()} == {
+        "month": 62,
+        "week": 31,
+        "day": 4,
+        "hot": 31,
+    }
+
+    calls.clear()
+    assert await reddit_adapter.get_posts("r/python", 8, adaptive=False) == posts
+    assert sorted(calls) == [("hot", 4), ("month", 8), ("week", 4)]
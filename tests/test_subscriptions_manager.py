@@ -0,0 +1,362 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from .. import subscriptions_manager
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    subscriptions_manager.close_connections()
+    monkeypatch.setattr(
+        subscriptions_manager, "DB_PATH", str(tmp_path / "subscriptions.db")
+    )
+    subscriptions_manager.create_tables()
+    subscriptions_manager.SENT_CACHE.clear()
+    monkeypatch.setattr(
+        subscriptions_manager, "WRITE_BUFFER", subscriptions_manager.WriteBuffer()
+    )
+    yield
+    subscriptions_manager.close_connections()
+
+
+def test_connection_is_reused_in_wal_mode():
+    connection = subscriptions_manager.get_connection()
+    assert connection is subscriptions_manager.get_connection()
+    assert connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+@pytest.mark.asyncio
+async def test_queries_run_off_the_event_loop_thread(monkeypatch: pytest.MonkeyPatch):
+    threads = set()
+    run_sql = subscriptions_manager.run_sql
+
+    def recording_run_sql(*args):
+        threads.add(threading.current_thread())
+        run_sql(*args)
+
+    monkeypatch.setattr(subscriptions_manager, "run_sql", recording_run_sql)
+    await asyncio.gather(
+        *(subscriptions_manager.subscribe(i, "r/python", 31) for i in range(10))
+    )
+    assert len(threads) == 1
+    assert threading.current_thread() not in threads
+    assert len(await subscriptions_manager.sub_followers("r/python")) == 10
+
+
+@pytest.mark.asyncio
+async def test_subscribe():
+    assert await subscriptions_manager.subscribe(1, "r/python", 31)
+    assert not await subscriptions_manager.subscribe(1, "r/python", 31)
+    assert await subscriptions_manager.is_subscribed(1, "r/python")
+    await subscriptions_manager.update_per_month(1, "r/python", 62)
+    assert await subscriptions_manager.user_subscriptions(1) == [("r/python", 62)]
+    assert await subscriptions_manager.unsubscribe(1, "r/python")
+    assert not await subscriptions_manager.unsubscribe(1, "r/python")
+    assert await subscriptions_manager.user_subscriptions(1) == []
+
+
+@pytest.mark.asyncio
+async def test_next_due_at_follows_messages_and_per_month():
+    await subscriptions_manager.subscribe(1, "r/python", 31)
+    ((last_sent_at, next_due_at),) = await subscriptions_manager.exec_select(
+        "SELECT last_sent_at, next_due_at FROM subscriptions"
+    )
+    assert last_sent_at is None
+    assert next_due_at == 86400
+
+    await subscriptions_manager.mark_as_sent(1, "abc", "r/python")
+    ((last_sent_at, next_due_at),) = await subscriptions_manager.exec_select(
+        "SELECT last_sent_at, next_due_at FROM subscriptions"
+    )
+    assert abs(last_sent_at - time.time()) < 5
+    assert next_due_at == last_sent_at + 86400
+
+    await subscriptions_manager.update_per_month(1, "r/python", 62)
+    ((next_due_at,),) = await subscriptions_manager.exec_select(
+        "SELECT next_due_at FROM subscriptions"
+    )
+    assert next_due_at == last_sent_at + 43200
+
+    # Subscribing again remembers what was sent before
+    await subscriptions_manager.unsubscribe(1, "r/python")
+    await subscriptions_manager.subscribe(1, "r/python", 31)
+    ((resubscribed_last_sent_at,),) = await subscriptions_manager.exec_select(
+        "SELECT last_sent_at FROM subscriptions"
+    )
+    assert resubscribed_last_sent_at == last_sent_at
+
+
+def test_migrations_from_unversioned_database(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE subscriptions(chat_id INTEGER NOT NULL, subreddit TEXT NOT NULL, "
+            "per_month INTEGER NOT NULL, timestamp DATETIME, PRIMARY KEY (chat_id, subreddit))"
+        )
+        connection.execute(
+            "CREATE TABLE messages(chat_id INTEGER NOT NULL, post_id TEXT NOT NULL, "
+            "timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, subreddit TEXT, "
+            "PRIMARY KEY (chat_id, post_id))"
+        )
+        connection.execute("INSERT INTO subscriptions VALUES (1, 'r/python', 31, NULL)")
+        connection.execute("INSERT INTO subscriptions VALUES (2, 'r/rust', 62, NULL)")
+        connection.execute(
+            "INSERT INTO messages VALUES (1, 'abc', '2020-01-01 00:00:00', 'r/python')"
+        )
+        connection.execute(
+            "INSERT INTO messages VALUES "
+            "(1, 'no_message_found_at_1.5', '2019-01-01 00:00:00', 'r/python')"
+        )
+        connection.execute(
+            "CREATE INDEX messages_chat_id_post_id_idx ON messages(chat_id, post_id)"
+        )
+    connection.close()
+    subscriptions_manager.close_connections()
+    monkeypatch.setattr(subscriptions_manager, "DB_PATH", path)
+    subscriptions_manager.create_tables()
+    assert subscriptions_manager.run_select(
+        "SELECT chat_id, last_sent_at, next_due_at FROM subscriptions ORDER BY chat_id"
+    ) == [(1, 1577836800.0, 1577836800.0 + 86400), (2, None, 43200.0)]
+    assert subscriptions_manager.run_select(
+        "SELECT chat_id, post_id, sent_at, name FROM messages JOIN subreddits "
+        "ON subreddits.id = messages.subreddit_id"
+    ) == [(1, int("abc", 36), 1577836800, "r/python")]
+    connection = subscriptions_manager.get_connection()
+    assert connection.execute("PRAGMA user_version").fetchone() == (
+        len(subscriptions_manager.MIGRATIONS),
+    )
+    indexes = [
+        name
+        for (name,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='messages'"
+        )
+    ]
+    assert "messages_chat_id_post_id_idx" not in indexes
+
+    # Already up to date
+    subscriptions_manager.create_tables()
+    # The triggers follow the new columns
+    subscriptions_manager.run_sql("DELETE FROM subscriptions WHERE chat_id=1")
+    subscriptions_manager.run_sql(
+        "INSERT INTO subscriptions (chat_id, subreddit, per_month) VALUES (1, 'r/python', 31)"
+    )
+    subscriptions_manager.run_sql(
+        "INSERT INTO messages(chat_id, post_id, sent_at, subreddit_id) VALUES "
+        "(2, 1, 1600000000, (SELECT id FROM subreddits WHERE name='r/python'))"
+    )
+    subscriptions_manager.run_sql(
+        "INSERT INTO subscriptions (chat_id, subreddit, per_month) VALUES (2, 'r/python', 31)"
+    )
+    assert subscriptions_manager.run_select(
+        "SELECT chat_id, subreddit, last_sent_at FROM subscriptions ORDER BY chat_id, subreddit"
+    ) == [(1, "r/python", 1577836800), (2, "r/python", 1600000000), (2, "r/rust", None)]
+
+
+@pytest.mark.asyncio
+async def test_already_sent_ids():
+    post_ids = [f"post{i}" for i in range(1200)]
+    await subscriptions_manager.mark_as_sent(1, "post3", "r/python")
+    await subscriptions_manager.mark_as_sent(1, "post1100", "r/python")
+    await subscriptions_manager.mark_as_sent(2, "post4", "r/python")
+    assert await subscriptions_manager.already_sent_ids(1, post_ids) == {
+        "post3",
+        "post1100",
+    }
+    assert await subscriptions_manager.already_sent_ids(1, []) == set()
+
+
+@pytest.mark.asyncio
+async def test_delete_old_messages():
+    await subscriptions_manager.subscribe(1, "r/python", 31)
+    for i in range(25):
+        await subscriptions_manager.exec_sql(
+            "INSERT INTO messages(chat_id, post_id, sent_at) "
+            "VALUES (1, ?, CAST(strftime('%s', 'now') AS INTEGER) - 100 * 86400)",
+            (int(f"old{i}", 36),),
+        )
+    await subscriptions_manager.mark_as_sent(1, "new", "r/python")
+    ((last_sent_at,),) = await subscriptions_manager.exec_select(
+        "SELECT last_sent_at FROM subscriptions"
+    )
+
+    deleted, freed = await subscriptions_manager.delete_old_messages(
+        batch_size=10, pause=0
+    )
+    assert deleted == 25
+    assert freed >= 0
+    assert await subscriptions_manager.already_sent_ids(1, ["old0", "new"]) == {"new"}
+    assert await subscriptions_manager.exec_select(
+        "SELECT last_sent_at FROM subscriptions"
+    ) == [(last_sent_at,)]
+    assert await subscriptions_manager.delete_old_messages() == (0, 0)
+
+
+def test_bloom_filter():
+    bloom_filter = subscriptions_manager.BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom_filter.add(i)
+    assert all(i in bloom_filter for i in range(1000))
+    false_positives = sum(i in bloom_filter for i in range(10**6, 10**6 + 10000))
+    assert false_positives < 300
+    assert len(bloom_filter) < 1300
+
+
+@pytest.mark.asyncio
+async def test_sent_cache(monkeypatch: pytest.MonkeyPatch):
+    await subscriptions_manager.mark_as_sent(1, "old", "r/python")
+    cache = subscriptions_manager.SentCache(max_bytes=3000, min_capacity=1000)
+    monkeypatch.setattr(subscriptions_manager, "SENT_CACHE", cache)
+    queries = []
+    exec_select = subscriptions_manager.exec_select
+
+    async def recording_exec_select(query, parameters=(), **kwargs):
+        queries.append(query)
+        return await exec_select(query, parameters, **kwargs)
+
+    monkeypatch.setattr(subscriptions_manager, "exec_select", recording_exec_select)
+
+    # Concurrent lookups share one load, posts never sent need no query
+    results = await asyncio.gather(
+        subscriptions_manager.already_sent_ids(1, ["new1", "new2"]),
+        subscriptions_manager.already_sent_ids(1, ["new3"]),
+    )
+    assert results == [set(), set()]
+    assert len(queries) == 1
+    assert await subscriptions_manager.already_sent_ids(1, ["old", "new1"]) == {"old"}
+    assert len(queries) == 2
+
+    await subscriptions_manager.mark_as_sent(1, "new1", "r/python")
+    assert await subscriptions_manager.already_sent(1, "new1")
+
+    # Each filter takes about 1.2KB, so a third chat evicts the first
+    await subscriptions_manager.already_sent_ids(2, ["a"])
+    await subscriptions_manager.already_sent_ids(3, ["a"])
+    assert cache.stats()["chats"] == 2
+    queries.clear()
+    await subscriptions_manager.already_sent_ids(1, ["new2"])
+    assert len(queries) == 1
+
+
+@pytest.mark.asyncio
+async def test_write_buffer_commits_together(monkeypatch: pytest.MonkeyPatch):
+    batches = []
+    run_batch = subscriptions_manager.run_batch
+
+    def recording_run_batch(statements):
+        batches.append(len(statements))
+        run_batch(statements)
+
+    monkeypatch.setattr(subscriptions_manager, "run_batch", recording_run_batch)
+    buffer = subscriptions_manager.WRITE_BUFFER
+    buffer.max_delay = 0.05
+    await subscriptions_manager.subscribe(1, "r/python", 31)
+    for i in range(5):
+        await subscriptions_manager.mark_as_sent(1, f"post{i}", "r/python")
+    await subscriptions_manager.mark_as_sent(1, "post0", "r/python")  # duplicate
+    await subscriptions_manager.mark_exception_as_sent(1, "r/rust", "banned")
+    assert batches == []
+
+    # Read your writes, before and after the commit
+    assert await subscriptions_manager.already_sent_ids(1, ["post1", "other"]) == {
+        "post1"
+    }
+    assert batches == []
+    assert await subscriptions_manager.already_sent_exception(1, "r/rust", "banned")
+    assert batches == [13]  # subreddit lookup and message for each post
+
+    await subscriptions_manager.update_per_month(1, "r/python", 62)
+    assert batches == [13]
+    await asyncio.sleep(0.1)
+    assert batches == [13, 1]
+    assert await subscriptions_manager.get_per_month(1, "r/python") == 62
+
+    buffer.max_rows = 3
+    for i in range(3):
+        await subscriptions_manager.mark_as_sent(2, f"post{i}", "r/python")
+    assert batches == [13, 1, 3, 3]
+
+
+@pytest.mark.asyncio
+async def test_write_buffer_keeps_rows_of_failed_commit(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    failures = [sqlite3.OperationalError("database is locked")]
+    run_batch = subscriptions_manager.run_batch
+
+    def failing_run_batch(statements):
+        if failures:
+            raise failures.pop()
+        run_batch(statements)
+
+    monkeypatch.setattr(subscriptions_manager, "run_batch", failing_run_batch)
+    subscriptions_manager.WRITE_BUFFER.max_delay = 0.05
+    await subscriptions_manager.subscribe(1, "r/python", 31)
+    await subscriptions_manager.mark_as_sent(1, "abc", "r/python")
+    await asyncio.sleep(0.1)
+    assert not failures
+    await asyncio.sleep(0.1)
+    assert await subscriptions_manager.exec_select(
+        "SELECT COUNT(*) FROM messages", flush=False
+    ) == [(1,)]
+
+
+@pytest.mark.asyncio
+async def test_subreddit_metadata():
+    await subscriptions_manager.save_subreddit_metadata(
+        "r/python", "available", True, 10, 2.5
+    )
+    await subscriptions_manager.save_subreddit_metadata("r/python", "private")
+    metadata = await subscriptions_manager.get_subreddit_metadata("r/python", 3600)
+    assert metadata is not None
+    # Values not given keep what was known before
+    assert (
+        metadata["status"],
+        metadata["over_18"],
+        metadata["subscribers"],
+        metadata["posts_per_day"],
+    ) == ("private", True, 10, 2.5)
+
+    for chat_id, subreddit in ((1, "r/python"), (1, "r/rust"), (2, "u/spez")):
+        await subscriptions_manager.subscribe(chat_id, subreddit, 31)
+    await subscriptions_manager.mark_exception_as_sent(3, "r/golang", "banned")
+    # Users are checked from their listing instead
+    await subscriptions_manager.mark_exception_as_sent(3, "u/someone", "private")
+    stale = await subscriptions_manager.subreddits_with_stale_metadata(3600, 10)
+    assert set(stale) == {"r/rust", "r/golang"}
+
+    await subscriptions_manager.exec_sql(
+        "UPDATE subreddit_metadata SET updated_at=datetime('now', '-2 hours')"
+    )
+    assert await subscriptions_manager.get_subreddit_metadata("r/python", 3600) is None
+    stale = await subscriptions_manager.subreddits_with_stale_metadata(3600, 10)
+    assert stale[-1] == "r/python"
+    assert await subscriptions_manager.subreddits_with_stale_metadata(3600, 1) != [
+        "r/python"
+    ]
+
+
+def test_run_batch_rolls_back_on_operational_errors():
+    subscriptions_manager.run_batch(
+        [
+            ("INSERT INTO subreddits (name) VALUES (?)", ("r/python",)),
+            ("INSERT INTO subreddits (name) VALUES (?)", ("r/python",)),  # skipped
+            ("INSERT INTO subreddits (name) VALUES (?)", ("r/rust",)),
+        ]
+    )
+    with pytest.raises(sqlite3.OperationalError):
+        subscriptions_manager.run_batch(
+            [
+                ("INSERT INTO subreddits (name) VALUES (?)", ("r/golang",)),
+                ("INSERT INTO missing_table VALUES (?)", (1,)),
+            ]
+        )
+    assert subscriptions_manager.run_select(
+        "SELECT name FROM subreddits ORDER BY name"
+    ) == [("r/python",), ("r/rust",)]
@@ -0,0 +1,67 @@
+import pytest
+from aiogram.utils import exceptions
+
+from .. import telegram_adapter
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch):
+    now = [1642364229.0]
+    sleeps = []
+
+    async def fake_sleep(delay: float):
+        sleeps.append(delay)
+        now[0] += delay
+
+    monkeypatch.setattr(telegram_adapter.time, "time", lambda: now[0])
+    monkeypatch.setattr(telegram_adapter.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(telegram_adapter, "BACKOFF", telegram_adapter.Backoff())
+    return sleeps
+
+
+def test_backoff_scopes():
+    backoff = telegram_adapter.Backoff()
+    backoff.pause(30, chat_id=1)
+    assert backoff.remaining(1) == pytest.approx(30, abs=1)
+    assert backoff.remaining(2) == 0
+    backoff.pause(60)
+    assert backoff.remaining(2) == pytest.approx(60, abs=1)
+    assert backoff.remaining(1) == pytest.approx(60, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_only_the_chat(clock):
+    attempts = []
+
+    @telegram_adapter.catch_telegram_exceptions
+    async def send(chat_id: int, text: str) -> bool:
+        attempts.append(chat_id)
+        if chat_id == 1 and len(attempts) == 1:
+            raise exceptions.RetryAfter(5)
+        return True
+
+    with pytest.raises(telegram_adapter.SendingPaused) as paused:
+        await send(1, "hi")
+    assert paused.value.delay == 6
+    # Not even tried while paused, other chats go on
+    with pytest.raises(telegram_adapter.SendingPaused):
+        await send(1, "hi")
+    assert await send(2, "hi")
+    assert attempts == [1, 2]
+    assert clock == []
+
+
+@pytest.mark.asyncio
+async def test_send_message_waits_out_pauses(clock, monkeypatch: pytest.MonkeyPatch):
+    sent = []
+
+    async def fake_send_message(chat_id: int, text: str):
+        if not sent:
+            sent.append(None)
+            raise exceptions.RetryAfter(5)
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(telegram_adapter.bot, "send_message", fake_send_message)
+    assert await telegram_adapter.send_message(1, "hi")
+    assert sent == [None, (1, "hi")]
+    assert clock == [6]
@@ -0,0 +1,348 @@
+import asyncio
+import time
+from typing import Any
+
+import pytest
+
+from .. import workers
+
+
+@pytest.mark.asyncio
+async def test_scheduler_orders_by_next_due_at():
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 300)
+    scheduler.scheduled(2, "r/rust", 31, None, 100)
+    scheduler.scheduled(3, "r/golang", 31, None, 200)
+    # Rescheduling replaces the previous heap item
+    scheduler.scheduled(2, "r/rust", 62, None, 400)
+    scheduler.unscheduled(3, "r/golang")
+
+    assert [(await scheduler.next_due())[:3] for _ in range(2)] == [
+        ("r/python", 1, 31),
+        ("r/rust", 2, 62),
+    ]
+    assert len(scheduler) == 2
+
+
+@pytest.mark.asyncio
+async def test_scheduler_sent_and_done():
+    scheduler = workers.Scheduler(retry_delay=600)
+    scheduler.scheduled(1, "r/python", 31, None, 0)
+    scheduler.scheduled(2, "r/rust", 31, None, 0)
+
+    subreddit, chat_id, _, version = await scheduler.next_due()
+    scheduler.sent(chat_id, subreddit, time.time())
+    scheduler.done(chat_id, subreddit, version)
+    assert (chat_id, subreddit) not in scheduler._unsaved
+
+    subreddit, chat_id, _, version = await scheduler.next_due()
+    scheduler.done(chat_id, subreddit, version)  # nothing was sent, retry later
+    assert scheduler._unsaved[(chat_id, subreddit)] == pytest.approx(
+        time.time() + 600, abs=5
+    )
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.next_due(), 0.05)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_wakes_up_on_changes():
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, time.time() + 3600)
+    next_due = asyncio.create_task(scheduler.next_due())
+    await asyncio.sleep(0.01)
+    assert not next_due.done()
+    scheduler.scheduled(2, "r/rust", 31, None, 0)
+    assert (await asyncio.wait_for(next_due, 1))[:2] == ("r/rust", 2)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_flush(monkeypatch: pytest.MonkeyPatch):
+    saved = []
+
+    async def fake_save_next_due_times(due_times):
+        saved.extend(due_times)
+
+    monkeypatch.setattr(
+        workers.subscriptions_manager, "save_next_due_times", fake_save_next_due_times
+    )
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 0)
+    scheduler.defer(1, "r/python", 1000)
+    scheduler.defer(1, "r/python", 2000)
+    await scheduler.flush()
+    await scheduler.flush()
+    assert saved == [(2000, 1, "r/python")]
+
+
+@pytest.mark.asyncio
+async def test_first_unsent_post_queries_once_per_batch(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    now = time.time()
+    batches = [
+        [{"id": "a", "created_utc": now}, {"id": "b", "created_utc": now}],
+        [{"id": "a", "created_utc": now}, {"id": "old", "created_utc": 0}],
+        [{"id": "c", "created_utc": now}],
+    ]
+    queries = []
+
+    async def fake_candidate_posts(_subreddit, _per_month, _posts):
+        for batch in batches:
+            yield batch
+
+    async def fake_already_sent_ids(_chat_id, post_ids):
+        queries.append(post_ids)
+        return {"a", "b"}
+
+    monkeypatch.setattr(workers, "candidate_posts", fake_candidate_posts)
+    monkeypatch.setattr(
+        workers.subscriptions_manager, "already_sent_ids", fake_already_sent_ids
+    )
+    post = await workers.first_unsent_post("r/python", 1, 31)
+    assert post == {"id": "c", "created_utc": now}
+    assert queries == [["a", "b"], ["old"], ["c"]]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_hands_out_one_subscription_per_chat():
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 100)
+    scheduler.scheduled(1, "r/rust", 31, None, 200)
+    scheduler.scheduled(2, "r/golang", 31, None, 300)
+
+    first = await scheduler.next_due()
+    assert first[:2] == ("r/python", 1)
+    # r/rust waits for chat 1 to be done
+    assert (await scheduler.next_due())[:2] == ("r/golang", 2)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.next_due(), 0.05)
+
+    scheduler.sent(1, "r/python", time.time())
+    scheduler.done(1, "r/python", first[3])
+    assert (await asyncio.wait_for(scheduler.next_due(), 1))[:2] == ("r/rust", 1)
+
+
+@pytest.mark.asyncio
+async def test_deliveries_to_a_chat_do_not_overlap(monkeypatch: pytest.MonkeyPatch):
+    running = set()
+    overlaps = []
+
+    async def fake_send_subscription_update(subreddit, chat_id, _per_month, _posts):
+        overlaps.append(chat_id in running)
+        running.add(chat_id)
+        await asyncio.sleep(0.01)
+        running.remove(chat_id)
+
+    monkeypatch.setattr(
+        workers, "_send_subscription_update", fake_send_subscription_update
+    )
+    await asyncio.gather(
+        *(
+            workers.send_subscription_update(sub, chat_id, 31)
+            for chat_id in (1, 2)
+            for sub in ("r/python", "r/rust", "r/golang")
+        )
+    )
+    assert overlaps == [False] * 6
+
+
+@pytest.mark.asyncio
+async def test_scheduler_claim_due():
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 100)
+    scheduler.scheduled(2, "r/python", 62, None, 200)
+    scheduler.scheduled(3, "r/python", 31, None, time.time() + 3600)
+    scheduler.scheduled(4, "r/python", 31, None, 300)
+    scheduler.scheduled(4, "r/rust", 31, None, 50)
+    scheduler.scheduled(5, "r/rust", 31, None, 400)
+
+    assert (await scheduler.next_due())[:2] == ("r/rust", 4)
+    subreddit, chat_id, _, _ = await scheduler.next_due()
+    assert (subreddit, chat_id) == ("r/python", 1)
+    # Chat 4 is busy, chat 3 isn't due yet
+    claimed = scheduler.claim_due("r/python", time.time(), 10)
+    assert [claim[:2] for claim in claimed] == [(2, 62)]
+    # Claimed subscriptions aren't handed out again
+    assert (await scheduler.next_due())[:2] == ("r/rust", 5)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.next_due(), 0.05)
+
+    scheduler.done(2, "r/python", claimed[0][2])  # nothing sent, retry later
+    assert scheduler._unsaved[(2, "r/python")] == pytest.approx(
+        time.time() + scheduler.retry_delay, abs=5
+    )
+
+
+@pytest.mark.asyncio
+async def test_candidate_posts_threshold_reads_get_posts_hot_listing(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    now = time.time()
+    thresholds = workers.reddit_adapter.ScoreThresholds()
+    top: Any = [{"score": score, "created_utc": now} for score in (50, 40, 30)]
+    thresholds.update("r/python", top, limit=99)
+    hot_limits = []
+
+    async def fake_hot_posts(_subscription, limit: int):
+        hot_limits.append(limit)
+        hot = [{"id": "a", "score": 35}, {"id": "b", "score": 45}, {"id": "c"}]
+        return hot[:limit]
+
+    monkeypatch.setattr(workers.reddit_adapter, "SCORE_THRESHOLDS", thresholds)
+    monkeypatch.setattr(workers.reddit_adapter, "hot_posts", fake_hot_posts)
+    batches = workers.candidate_posts("r/python", 2)
+    assert [post["id"] for post in await batches.__anext__()] == []
+    batches = workers.candidate_posts("r/python", 4)
+    assert [post["id"] for post in await batches.__anext__()] == ["b", "a"]
+    assert hot_limits == [1, 2]
+
+
+def test_scheduler_per_month_updated():
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, 1000, 1000 + 86400)
+    scheduler.defer(1, "r/python", 5000)
+    scheduler.per_month_updated(1, "r/python", 62)
+    entry = scheduler._entries[(1, "r/python")]
+    assert (entry.per_month, entry.next_due_at) == (62, 1000 + 43200)
+    assert not scheduler._unsaved
+
+
+@pytest.mark.asyncio
+async def test_group_deliveries_share_listings_and_slots(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    requests = []
+    running = []
+    most_running = []
+
+    async def fake_get_top_posts(_subscription, time_period: str, limit: int):
+        requests.append(time_period)
+        return [{"id": f"{time_period}{i}", "score": i} for i in range(limit)]
+
+    async def fake_hot_posts(_subscription, limit: int):
+        requests.append("hot")
+        return [{"id": f"hot{i}", "score": i} for i in range(limit)]
+
+    async def fake_send_subscription_update(_subreddit, chat_id, per_month, listings):
+        running.append(chat_id)
+        most_running.append(len(running))
+        assert len(await listings.get_posts(per_month)) > 0
+        await asyncio.sleep(0.01)
+        running.remove(chat_id)
+
+    scheduler = workers.Scheduler()
+    for chat_id in range(20):
+        scheduler.scheduled(chat_id, "r/python", 31 * (1 + chat_id % 3), None, 0)
+    monkeypatch.setattr(workers, "SCHEDULER", scheduler)
+    monkeypatch.setattr(workers.reddit_adapter, "get_top_posts", fake_get_top_posts)
+    monkeypatch.setattr(workers.reddit_adapter, "hot_posts", fake_hot_posts)
+    monkeypatch.setattr(
+        workers.reddit_adapter, "SOURCE_STATS", workers.reddit_adapter.SourceStats()
+    )
+    monkeypatch.setattr(
+        workers, "send_subscription_update", fake_send_subscription_update
+    )
+
+    subreddit, chat_id, per_month, version = await scheduler.next_due()
+    group = [(chat_id, per_month, version)]
+    group += scheduler.claim_due(subreddit, time.time(), 100)
+    assert len(group) == 20
+    await workers.send_subreddit_updates(subreddit, group, asyncio.Semaphore(4))
+    assert group == []
+    assert max(most_running) == 4
+    assert sorted(requests) == ["day", "hot", "month", "week"]
+    # Every chat is free and due again later
+    assert not scheduler._busy_chats
+    assert len(scheduler._unsaved) == 20
+
+
+@pytest.mark.asyncio
+async def test_scheduler_skips_paused_chats(monkeypatch: pytest.MonkeyPatch):
+    backoff = workers.telegram_adapter.Backoff()
+    monkeypatch.setattr(workers.telegram_adapter, "BACKOFF", backoff)
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 100)
+    scheduler.scheduled(1, "r/rust", 31, None, 200)
+    scheduler.scheduled(2, "r/python", 31, None, 300)
+    backoff.pause(3600, chat_id=1)
+
+    assert (await scheduler.next_due())[:2] == ("r/python", 2)
+    assert scheduler.claim_due("r/rust", time.time(), 10) == []
+    # Both subscriptions of chat 1 wait for the end of its pause
+    assert scheduler._unsaved == {
+        (1, "r/python"): pytest.approx(time.time() + 3600, abs=5),
+        (1, "r/rust"): pytest.approx(time.time() + 3600, abs=5),
+    }
+
+
+@pytest.mark.asyncio
+async def test_paused_delivery_is_requeued(monkeypatch: pytest.MonkeyPatch):
+    backoff = workers.telegram_adapter.Backoff()
+
+    async def fake_send_subscription_update(_subreddit, chat_id, _per_month, _):
+        backoff.pause(30, chat_id)
+        raise workers.telegram_adapter.SendingPaused(chat_id, 30)
+
+    scheduler = workers.Scheduler()
+    scheduler.scheduled(1, "r/python", 31, None, 0)
+    monkeypatch.setattr(workers, "SCHEDULER", scheduler)
+    monkeypatch.setattr(workers.telegram_adapter, "BACKOFF", backoff)
+    monkeypatch.setattr(
+        workers, "send_subscription_update", fake_send_subscription_update
+    )
+    subreddit, chat_id, per_month, version = await scheduler.next_due()
+    group = [(chat_id, per_month, version)]
+    await workers.send_subreddit_updates(subreddit, group, asyncio.Semaphore(1))
+    assert not scheduler._busy_chats
+    assert scheduler._unsaved == {
+        (1, "r/python"): pytest.approx(time.time() + 30, abs=5)
+    }
+
+
+@pytest.mark.asyncio
+async def test_group_with_nothing_left_shares_every_request(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    now = time.time()
+    endpoints = []
+
+    async def fake_get_page_from_endpoint(endpoint: str):
+        endpoints.append(endpoint)
+        query = dict(part.split("=") for part in endpoint.split("?")[1].split("&"))
+        limit = int(query["limit"])
+        posts: Any = [
+            {"id": f"{len(endpoints)}_{i}", "score": i, "created_utc": now}
+            for i in range(limit)
+        ]
+        return workers.reddit_adapter.ListingPage(posts, f"t3_{len(endpoints)}")
+
+    async def fake_already_sent_ids(_chat_id, post_ids):
+        return set(post_ids)
+
+    reddit_adapter = workers.reddit_adapter
+    monkeypatch.setattr(
+        reddit_adapter, "get_page_from_endpoint", fake_get_page_from_endpoint
+    )
+    monkeypatch.setattr(
+        reddit_adapter, "LISTING_CACHE", reddit_adapter.TTLCache(60, 99)
+    )
+    monkeypatch.setattr(
+        reddit_adapter, "SCORE_THRESHOLDS", reddit_adapter.ScoreThresholds()
+    )
+    monkeypatch.setattr(reddit_adapter, "SOURCE_STATS", reddit_adapter.SourceStats())
+    monkeypatch.setattr(
+        workers.subscriptions_manager, "already_sent_ids", fake_already_sent_ids
+    )
+
+    per_months = [31, 62, 93, 124, 155]
+    listings = reddit_adapter.GroupListings("r/python", per_months)
+    for chat_id, per_month in enumerate(per_months):
+        assert (
+            await workers.first_unsent_post("r/python", chat_id, per_month, listings)
+            is None
+        )
+    assert len(endpoints) == len(set(endpoints)) == 5
+    assert endpoints[-1].startswith(
+        "https://oauth.reddit.com/r/python/top.json?limit=56&t=month&after="
+    )
@@ -1,61 +1,166 @@
 import asyncio
+import heapq
+import itertools
 import logging
 import time
-from typing import Any
+import weakref
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 
 import reddit_adapter
 import subscriptions_manager
 import telegram_adapter
 
 
-async def send_subscription_update(subreddit: str, chat_id: int, per_month: int):
-    # Send top unsent post from subreddit to chat_id
-    # per_month is used only to choose where to look for posts (see get_posts)
-    try:
-        posts = reddit_adapter.get_posts(subreddit, per_month)
-        if per_month > 200:
-            posts += reddit_adapter.new_posts(subreddit)
-        for post in posts:
-            if subscriptions_manager.already_sent(chat_id, post["id"]):
+async def candidate_posts(
+    subreddit: str,
+    per_month: int,
+    listings: Optional[reddit_adapter.GroupListings] = None,
+) -> AsyncIterator[List[reddit_adapter.Post | reddit_adapter.Comment]]:
+    """
+    Batches of posts to send from subreddit, best first. Further pages of the
+    month's top posts are fetched only if the consumer gets that far.
+    listings is shared with other subscriptions to subreddit delivered together
+    """
+    if listings is None:
+        listings = reddit_adapter.GroupListings(subreddit, [per_month])
+    threshold = reddit_adapter.SCORE_THRESHOLDS.threshold(subreddit, per_month)
+    if threshold is not None:
+        # Hot posts that would rank among the month's per_month best, from the
+        # same hot listing get_posts reads
+        hot_posts = await listings.hot_posts(per_month)
+        yield [
+            post
+            for post in sorted(hot_posts, key=lambda post: post["score"], reverse=True)
+            if post["score"] >= threshold
+        ]
+    yield await listings.get_posts(per_month)
+    if per_month > 99:
+        # get_posts only sees the first page of top posts
+        async for page in listings.month_pages(per_month):
+            yield page
+    if per_month > 200:
+        yield await reddit_adapter.new_posts(subreddit)
+    # Listings get_posts skipped might still have something
+    yield await listings.get_posts(per_month, adaptive=False)
+
+
+async def first_unsent_post(
+    subreddit: str,
+    chat_id: int,
+    per_month: int,
+    listings: Optional[reddit_adapter.GroupListings] = None,
+) -> Optional[reddit_adapter.Post | reddit_adapter.Comment]:
+    # One already_sent_ids query per batch of candidates
+    seen: Set[str] = set()
+    async for batch in candidate_posts(subreddit, per_month, listings):
+        batch = [post for post in batch if post["id"] not in seen]
+        seen.update(post["id"] for post in batch)
+        if not batch:
+            continue
+        sent_ids = await subscriptions_manager.already_sent_ids(
+            chat_id, [post["id"] for post in batch]
+        )
+        for post in batch:
+            if post["id"] in sent_ids:
                 continue
             if post["created_utc"] < time.time() - 86400 * 90:
                 continue
+            return post
+    return None
+
+
+# Held while delivering to a chat, so it never gets two posts at once
+_chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = (
+    weakref.WeakValueDictionary()
+)
+
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
+
+
+async def send_subscription_update(
+    subreddit: str,
+    chat_id: int,
+    per_month: int,
+    listings: Optional[reddit_adapter.GroupListings] = None,
+):
+    async with chat_lock(chat_id):
+        await _send_subscription_update(subreddit, chat_id, per_month, listings)
+
+
+async def _send_subscription_update(
+    subreddit: str,
+    chat_id: int,
+    per_month: int,
+    listings: Optional[reddit_adapter.GroupListings] = None,
+):
+    # Send top unsent post from subreddit to chat_id
+    # per_month is used only to choose where to look for posts (see get_posts)
+    try:
+        if reddit_adapter.is_subreddit(subreddit):
+            metadata = await subscriptions_manager.get_subreddit_metadata(
+                subreddit, reddit_adapter.METADATA_MAX_AGE
+            )
+            if metadata and metadata["status"] == "banned":
+                raise reddit_adapter.SubredditBanned()
+            if metadata and metadata["status"] == "private":
+                raise reddit_adapter.SubredditPrivate()
+        post = await first_unsent_post(subreddit, chat_id, per_month, listings)
+        if post is not None:
             await telegram_adapter.send_post(chat_id, post, subreddit)
-            break
+            reddit_adapter.SOURCE_STATS.record_delivery(
+                subreddit,
+                post["id"],
+                reddit_adapter.listing_limits(subreddit, per_month),
+            )
         else:
             logging.info(
                 f"No post to send from {subreddit} to {chat_id}, {per_month=}. Halving per_month"
             )
-            subscriptions_manager.update_per_month(
+            await subscriptions_manager.update_per_month(
                 chat_id, subreddit, max(per_month // 2, 1)
             )
-            subscriptions_manager.mark_as_sent(
-                chat_id, f"no_message_found_at_{time.time()}", subreddit
-            )
+            await subscriptions_manager.mark_as_checked(chat_id, subreddit)
     except reddit_adapter.SubredditBanned:
-        if not subscriptions_manager.already_sent_exception(
+        if not await subscriptions_manager.already_sent_exception(
             chat_id, subreddit, "banned"
         ):
-            await telegram_adapter.send_message(
+            await telegram_adapter.try_send_message(
                 chat_id, f"r/{subreddit} has been banned"
             )
-            subscriptions_manager.mark_exception_as_sent(chat_id, subreddit, "banned")
-        subscriptions_manager.unsubscribe(chat_id, subreddit)
+            await subscriptions_manager.mark_exception_as_sent(
+                chat_id, subreddit, "banned"
+            )
+        if reddit_adapter.is_subreddit(subreddit):
+            await subscriptions_manager.save_subreddit_metadata(subreddit, "banned")
+        await subscriptions_manager.unsubscribe(chat_id, subreddit)
     except reddit_adapter.SubredditPrivate:
-        if not subscriptions_manager.already_sent_exception(
+        if not await subscriptions_manager.already_sent_exception(
             chat_id, subreddit, "private"
         ):
-            await telegram_adapter.send_message(
+            await telegram_adapter.try_send_message(
                 chat_id, f"r/{subreddit} has been made private"
             )
-            subscriptions_manager.mark_exception_as_sent(chat_id, subreddit, "private")
-        subscriptions_manager.unsubscribe(chat_id, subreddit)
+            await subscriptions_manager.mark_exception_as_sent(
+                chat_id, subreddit, "private"
+            )
+        if reddit_adapter.is_subreddit(subreddit):
+            await subscriptions_manager.save_subreddit_metadata(subreddit, "private")
+        await subscriptions_manager.unsubscribe(chat_id, subreddit)
+    except reddit_adapter.CircuitOpen as e:
+        logging.info(f"Skipping {subreddit} for {chat_id}: {e}")
+    except telegram_adapter.SendingPaused:
+        raise  # the scheduler sends it again once the pause ends
     except Exception as e:
-        logging.error(f"{e!r} while sending sub updates, sleeping")
+        logging.error(f"{e!r} while sending sub updates")
         await telegram_adapter.send_exception(
             e, f"send_subscription_update({subreddit}, {chat_id}, {per_month})"
         )
-        time.sleep(30)
 
 
 async def check_exceptions(refresh_period: int = 48 * 60 * 60):
@@ -64,43 +169,357 @@ async def check_exceptions(refresh_period: int = 48 * 60 * 60):
     """
     await asyncio.sleep(refresh_period)
     while True:
-        unavailable_subs = subscriptions_manager.unavailable_subreddits()
+        unavailable_subs = await subscriptions_manager.unavailable_subreddits()
+        # refresh_metadata keeps most of these up to date
+        metadata = {
+            sub: await subscriptions_manager.get_subreddit_metadata(
+                sub, reddit_adapter.METADATA_MAX_AGE
+            )
+            for sub in unavailable_subs
+        }
+        unknown_subs = [sub for sub in unavailable_subs if metadata[sub] is None]
+        # Private and banned subreddits have no posts in a combined listing
+        batch_posts = await reddit_adapter.new_posts_batch(unknown_subs, limit=1)
         for sub in unavailable_subs:
             try:
-                try:
-                    reddit_adapter.new_posts(sub)
-                except (
-                    reddit_adapter.SubredditPrivate,
-                    reddit_adapter.SubredditBanned,
-                ):
-                    continue
-                old_subscribers = subscriptions_manager.get_old_subscribers(sub)
+                sub_metadata = metadata[sub]
+                if sub_metadata is not None:
+                    if sub_metadata["status"] != "available":
+                        continue
+                else:
+                    try:
+                        if not batch_posts.get(sub):
+                            await reddit_adapter.new_posts(sub)
+                    except (
+                        reddit_adapter.SubredditPrivate,
+                        reddit_adapter.SubredditBanned,
+                    ):
+                        continue
+                old_subscribers = await subscriptions_manager.get_old_subscribers(sub)
                 for chat_id in old_subscribers:
-                    subscriptions_manager.subscribe(chat_id, sub, 31)
+                    await subscriptions_manager.subscribe(chat_id, sub, 31)
                     await telegram_adapter.send_message(
                         chat_id, f"{sub} is now available again"
                     )
-                subscriptions_manager.delete_exception(sub)
+                await subscriptions_manager.delete_exception(sub)
             except Exception as e:
                 await telegram_adapter.send_exception(
                     e, f"Exception while checking unavailability of {sub}"
                 )
         await asyncio.sleep(refresh_period)
 
-async def send_updates():
+
+async def refresh_metadata(refresh_period: int = 10 * 60, batch_size: int = 100):
+    """
+    Keep the stored status, NSFW flag, subscribers and activity of subscribed
+    and unavailable subreddits younger than METADATA_MAX_AGE
+    """
     while True:
-        (
-            subreddit,
-            chat_id,
-            per_month,
-            time_left
-        ) = subscriptions_manager.get_next_subscription_to_update()
-        logging.info(f"Sending {subreddit=} to {chat_id=} {per_month=} {time_left=}")
-        await asyncio.sleep(max(0.01, time_left))
-        logging.info(f"Sending {subreddit=} to {chat_id=} {per_month=}")
-        await send_subscription_update(subreddit, chat_id, per_month)
+        stale_subs = await subscriptions_manager.subreddits_with_stale_metadata(
+            reddit_adapter.METADATA_MAX_AGE, batch_size
+        )
+        for sub in stale_subs:
+            try:
+                await reddit_adapter.refresh_subreddit_metadata(sub)
+            except Exception as e:
+                logging.warning(f"{e!r} while refreshing metadata of {sub}")
+        await asyncio.sleep(refresh_period)
+
+
+class ScheduleEntry:
+    __slots__ = ("per_month", "last_sent_at", "next_due_at", "version")
+
+    def __init__(
+        self, per_month: int, last_sent_at: Optional[float], next_due_at: float
+    ):
+        self.per_month = per_month
+        self.last_sent_at = last_sent_at
+        self.next_due_at = next_due_at
+        self.version = 0
+
+
+class Scheduler:
+    """
+    Priority queue of subscriptions by next_due_at, loaded once and then kept
+    up to date by subscriptions_manager as a ScheduleListener.
+    Superseded heap items are skipped when they come up instead of removed.
+    Items of a chat with a subscription being delivered wait aside until it's
+    done. next_due_at changes subscriptions_manager doesn't know about
+    (deferrals) are written back by flush
+    """
+
+    def __init__(self, retry_delay: float = 10 * 60):
+        self.retry_delay = retry_delay
+        self._entries: Dict[Tuple[int, str], ScheduleEntry] = {}
+        self._heap: List[Tuple[float, int, int, str]] = []
+        self._versions = itertools.count(1)
+        self._unsaved: Dict[Tuple[int, str], float] = {}
+        self._changed = asyncio.Event()
+        self._busy_chats: Set[int] = set()
+        self._parked: Dict[int, List[Tuple[float, int, int, str]]] = {}
+        self._followers: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def load(self):
+        for chat_id, subreddit, per_month, last_sent_at, next_due_at in (
+            await subscriptions_manager.get_schedule()
+        ):
+            self.scheduled(chat_id, subreddit, per_month, last_sent_at, next_due_at)
+
+    def _push(self, chat_id: int, subreddit: str, entry: ScheduleEntry):
+        entry.version = next(self._versions)
+        item = (entry.next_due_at, entry.version, chat_id, subreddit)
+        heapq.heappush(self._heap, item)
+        self._changed.set()
+
+    def scheduled(
+        self,
+        chat_id: int,
+        subreddit: str,
+        per_month: int,
+        last_sent_at: Optional[float],
+        next_due_at: float,
+    ):
+        entry = ScheduleEntry(per_month, last_sent_at, next_due_at)
+        self._entries[(chat_id, subreddit)] = entry
+        self._followers.setdefault(subreddit, set()).add(chat_id)
+        self._unsaved.pop((chat_id, subreddit), None)
+        self._push(chat_id, subreddit, entry)
+
+    def unscheduled(self, chat_id: int, subreddit: str):
+        self._entries.pop((chat_id, subreddit), None)
+        self._unsaved.pop((chat_id, subreddit), None)
+        followers = self._followers.get(subreddit)
+        if followers is not None:
+            followers.discard(chat_id)
+            if not followers:
+                del self._followers[subreddit]
+
+    def sent(self, chat_id: int, subreddit: str, sent_at: float):
+        entry = self._entries.get((chat_id, subreddit))
+        if entry is None:
+            return
+        entry.last_sent_at = sent_at
+        entry.next_due_at = sent_at + 31 * 24 * 3600 / entry.per_month
+        self._unsaved.pop((chat_id, subreddit), None)
+        self._push(chat_id, subreddit, entry)
+
+    def per_month_updated(self, chat_id: int, subreddit: str, per_month: int):
+        entry = self._entries.get((chat_id, subreddit))
+        if entry is None:
+            return
+        entry.per_month = per_month
+        # Like the database's subscription_due_per_month_trigger
+        entry.next_due_at = (entry.last_sent_at or 0) + 31 * 24 * 3600 / per_month
+        self._unsaved.pop((chat_id, subreddit), None)
+        self._push(chat_id, subreddit, entry)
+
+    def defer(self, chat_id: int, subreddit: str, until: float):
+        entry = self._entries.get((chat_id, subreddit))
+        if entry is None:
+            return
+        entry.next_due_at = until
+        self._unsaved[(chat_id, subreddit)] = until
+        self._push(chat_id, subreddit, entry)
+
+    def _peek(self) -> Optional[Tuple[float, int, int, str]]:
+        while self._heap:
+            next_due_at, version, chat_id, subreddit = self._heap[0]
+            entry = self._entries.get((chat_id, subreddit))
+            if entry is not None and entry.version == version:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    async def next_due(self) -> Tuple[str, int, int, int]:
+        """
+        Waits for the most overdue subscription, returns
+        (subreddit, chat_id, per_month, version). It leaves the queue until
+        it's sent or passed to done. Subscriptions of chats telegram_adapter
+        pauses are due again when the pause ends
+        """
+        while True:
+            self._changed.clear()
+            head = self._peek()
+            while head is not None and head[2] in self._busy_chats:
+                self._parked.setdefault(head[2], []).append(heapq.heappop(self._heap))
+                head = self._peek()
+            timeout = 60.0 if head is None else head[0] - time.time()
+            if head is not None and timeout <= 0:
+                _, version, chat_id, subreddit = head
+                backoff = telegram_adapter.BACKOFF
+                if (paused := backoff.remaining()) > 0:
+                    await asyncio.sleep(paused)
+                    continue
+                if (paused := backoff.remaining(chat_id)) > 0:
+                    self.defer(chat_id, subreddit, time.time() + paused)
+                    continue
+                heapq.heappop(self._heap)
+                self._busy_chats.add(chat_id)
+                per_month = self._entries[(chat_id, subreddit)].per_month
+                return subreddit, chat_id, per_month, version
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def claim_due(
+        self, subreddit: str, before: float, limit: int
+    ) -> List[Tuple[int, int, int]]:
+        """
+        Takes up to limit other subscriptions to subreddit due before the given
+        time, of chats not busy, like next_due would one by one.
+        Returns (chat_id, per_month, version) for each
+        """
+        claimed: List[Tuple[int, int, int]] = []
+        for chat_id in self._followers.get(subreddit, ()):
+            if len(claimed) >= limit:
+                break
+            entry = self._entries[(chat_id, subreddit)]
+            if chat_id in self._busy_chats or entry.next_due_at > before:
+                continue
+            if telegram_adapter.BACKOFF.remaining(chat_id) > 0:
+                continue
+            # Its heap item is skipped from now on
+            entry.version = next(self._versions)
+            self._busy_chats.add(chat_id)
+            claimed.append((chat_id, entry.per_month, entry.version))
+        return claimed
+
+    def done(self, chat_id: int, subreddit: str, version: int):
+        """
+        Frees the chat for its other subscriptions.
+        Retry later if sending the subscription changed nothing
+        """
+        self._busy_chats.discard(chat_id)
+        for item in self._parked.pop(chat_id, []):
+            heapq.heappush(self._heap, item)
+            self._changed.set()
+        entry = self._entries.get((chat_id, subreddit))
+        if entry is not None and entry.version == version:
+            self.defer(chat_id, subreddit, time.time() + self.retry_delay)
+
+    async def flush(self):
+        unsaved, self._unsaved = self._unsaved, {}
+        if unsaved:
+            await subscriptions_manager.save_next_due_times(
+                (next_due_at, chat_id, subreddit)
+                for (chat_id, subreddit), next_due_at in unsaved.items()
+            )
+
+
+SCHEDULER = Scheduler()
+subscriptions_manager.SCHEDULE_LISTENERS.append(SCHEDULER)
+
+
+# Subscriptions delivered at the same time, to different chats
+DELIVERY_CONCURRENCY = 8
+# When a subscription is due, other followers of the subreddit due within
+# this many seconds get their update too, from the same reddit requests
+GROUP_WINDOW = 10 * 60
+GROUP_SIZE = 100
+
+
+async def send_updates(concurrency: int = DELIVERY_CONCURRENCY):
+    await SCHEDULER.load()
+    logging.info(f"Loaded {len(SCHEDULER)} subscriptions")
+    # Deliveries of a group take slots too
+    slots = asyncio.Semaphore(concurrency)
+    await asyncio.gather(*(delivery_worker(slots) for _ in range(concurrency)))
+
+
+async def delivery_worker(slots: asyncio.Semaphore):
+    while True:
+        subreddit, chat_id, per_month, version = await SCHEDULER.next_due()
+        group = [(chat_id, per_month, version)] + SCHEDULER.claim_due(
+            subreddit, time.time() + GROUP_WINDOW, GROUP_SIZE - 1
+        )
+        try:
+            circuit_breaker = reddit_adapter.CIRCUIT_BREAKER
+            if circuit_breaker.is_open(subreddit):
+                # Subreddits reddit keeps failing for wait for their circuit to close
+                retry_at = circuit_breaker.retry_at(subreddit)
+                for chat_id, _, _ in group:
+                    SCHEDULER.defer(chat_id, subreddit, retry_at)
+                continue
+            await send_subreddit_updates(subreddit, group, slots)
+        finally:
+            # Whatever send_subreddit_updates didn't get to
+            for chat_id, _, version in group:
+                SCHEDULER.done(chat_id, subreddit, version)
+
+
+async def send_subreddit_updates(
+    subreddit: str, group: List[Tuple[int, int, int]], slots: asyncio.Semaphore
+):
+    """
+    Delivers subreddit to each (chat_id, per_month, version) of group, at most
+    as many at once as slots allows, sharing the listings they read.
+    Removes each from group when done with it
+    """
+    listings = reddit_adapter.GroupListings(
+        subreddit, {per_month for _, per_month, _ in group}
+    )
+
+    async def deliver(item: Tuple[int, int, int]):
+        chat_id, per_month, version = item
+        try:
+            async with slots:
+                logging.info(f"Sending {subreddit=} to {chat_id=} {per_month=}")
+                await send_subscription_update(subreddit, chat_id, per_month, listings)
+        except telegram_adapter.SendingPaused:
+            # Requeued for when the chat may be sent to again
+            paused = telegram_adapter.BACKOFF.remaining(chat_id)
+            SCHEDULER.defer(chat_id, subreddit, time.time() + paused)
+        finally:
+            # Free the chat for its other subscriptions right away
+            group.remove(item)
+            SCHEDULER.done(chat_id, subreddit, version)
+
+    results = await asyncio.gather(
+        *(deliver(item) for item in list(group)), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def persist_schedule(period: int = 60):
+    while True:
+        await asyncio.sleep(period)
+        try:
+            await SCHEDULER.flush()
+        except Exception as e:
+            logging.error(f"{e!r} while saving the schedule")
+
+
+async def compact_messages(period: int = 24 * 60 * 60):
+    while True:
+        try:
+            deleted, freed = await subscriptions_manager.delete_old_messages()
+            logging.info(
+                f"Deleted {deleted} old messages, {freed / 2**20:.1f} MiB free for reuse"
+            )
+        except Exception as e:
+            await telegram_adapter.send_exception(e, "compact_messages")
+        await asyncio.sleep(period)
+
 
 tasks = []
 async def on_startup(_dispatcher: Any):
+    subscriptions_manager.create_tables()
+    tasks.append(asyncio.create_task(reddit_adapter.TOKEN_MANAGER.keep_fresh()))
     tasks.append(asyncio.create_task(check_exceptions()))
+    tasks.append(asyncio.create_task(refresh_metadata()))
     tasks.append(asyncio.create_task(send_updates()))
+    tasks.append(asyncio.create_task(persist_schedule()))
+    tasks.append(asyncio.create_task(compact_messages()))
+
+
+async def on_shutdown(_dispatcher: Any):
+    for task in tasks:
+        task.cancel()
+    await subscriptions_manager.WRITE_BUFFER.flush()
+    await SCHEDULER.flush()